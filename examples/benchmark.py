@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+""" Benchmarks of packet handling and the cache
+
+Run "PYTHONPATH=. python examples/benchmark.py [name ...]" on a checkout
+before and after a change to compare them; with no names, all the
+benchmarks run.  Only the API zeroconf has had from the start is used,
+so that the same script runs against older versions.  To measure one
+without checking it out, write its zeroconf.py to a directory of its own
+and put that on PYTHONPATH instead:
+
+    mkdir /tmp/old && git show <revision>:zeroconf.py > /tmp/old/zeroconf.py
+    PYTHONPATH=/tmp/old python examples/benchmark.py records
+
+Compare numbers against the tree a series of changes started from, not
+only against the change before.
+"""
+
+import socket
+import struct
+import sys
+import threading
+import time
+import timeit
+
+import zeroconf as r
+
+
+def browse_response(count):
+    """Returns the packet of a response holding the PTR, SRV, TXT and A
+    records of count instances of _http._tcp.local."""
+    out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+    for record in browse_records(count):
+        out.add_answer_at_time(record, 0)
+    return out.packet()
+
+
+def browse_records(count, prefix="Service"):
+    records = []
+    for i in range(count):
+        name = "%s %d._http._tcp.local." % (prefix, i)
+        server = "host-%s-%d.local." % (prefix.lower(), i)
+        records.extend([
+            r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL, name),
+            r.DNSService(name, r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 80, server),
+            r.DNSText(name, r._TYPE_TXT, r._CLASS_IN, r._DNS_TTL,
+                      ('\x09path=/%03d' % (i % 1000)).encode()),
+            r.DNSAddress(server, r._TYPE_A, r._CLASS_IN, r._DNS_TTL,
+                         socket.inet_aton("10.0.%d.%d" % (i // 250 % 256, i % 250 + 1))),
+        ])
+    return records
+
+
+def optional_module(name):
+    """Returns the named module, or None after noting that the benchmark
+    is skipped where it is missing: tracemalloc needs Python 3.4, and
+    resource a Unix"""
+    try:
+        return __import__(name)
+    except ImportError:
+        print("skipped, no %s module" % name)
+        return None
+
+
+def best(function, number, repeat=5):
+    """Returns the best time of repeat runs of function number times, in
+    microseconds per call"""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def bench_parse():
+    """Parsing a 40-record browse response"""
+    packet = browse_response(10)
+    per_packet = best(lambda: r.DNSIncoming(packet).answers, 2000)
+    print("%d bytes: %.0f us per packet" % (len(packet), per_packet))
+
+
+def bench_names():
+    """Memory held by the records of 1250 copies of a 40-record browse
+    response, as a cache full of the same services holds them"""
+    tracemalloc = optional_module('tracemalloc')
+    if tracemalloc is None:
+        return
+    packet = browse_response(10)
+    tracemalloc.start()
+    records = []
+    for i in range(1250):
+        records.extend(r.DNSIncoming(bytes(bytearray(packet))).answers)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("%d records: %.1f MB" % (len(records), size / 1e6))
+
+
+def bench_build():
+    """Building responses of mixed PTR, SRV, TXT and A answers"""
+    for count in (1, 10, 100):
+        records = browse_records((count + 3) // 4)[:count]
+
+        def build():
+            out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+            for record in records:
+                out.add_answer_at_time(record, 0)
+            return out.packet()
+        print("%3d answers: %.1f us" % (count, best(build, 10000 // count, 10)))
+
+
+class Message(object):
+
+    """A response holding records that have already been decoded"""
+
+    def __init__(self, answers):
+        self.answers = answers
+
+
+def bench_cache():
+    """Filling the cache through Zeroconf.handle_response, refreshing a
+    record in it and listing its entries, at growing sizes until a fill
+    takes a minute"""
+    zc = r.Zeroconf()
+    try:
+        for count in (1000, 10000, 100000):
+            zc.cache = r.DNSCache()
+            records = browse_records(count // 4)
+            start = timeit.default_timer()
+            for i in range(0, count, 40):
+                zc.handle_response(Message(records[i:i + 40]))
+            fill = timeit.default_timer() - start
+            refresh = Message(browse_records(1))
+            print("%6d entries: fill %.3f s, refresh %.1f us per record, entries() %.1f ms" % (
+                count, fill, best(lambda: zc.handle_response(refresh), 20, 3) / 4,
+                best(zc.cache.entries, 10, 3) / 1000))
+            if fill > 60:
+                break
+    finally:
+        zc.close()
+
+
+def bench_records():
+    """Memory taken by 100k distinct A records in a cache"""
+    tracemalloc = optional_module('tracemalloc')
+    if tracemalloc is None:
+        return
+    tracemalloc.start()
+    cache = r.DNSCache()
+    for i in range(100000):
+        record = r.DNSAddress("host-%d.local." % i, r._TYPE_A, r._CLASS_IN, r._DNS_TTL,
+                              struct.pack(b'!I', i))
+        cache.add(record)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    record_size = sys.getsizeof(record)
+    if hasattr(record, '__dict__'):
+        record_size += sys.getsizeof(record.__dict__)
+    print("record object: %d B, traced total: %.1f MB (%.0f B per record)" % (
+        record_size, size / 1e6, size / 100000))
+
+
+def bench_budget():
+    """Memory taken by 25k services' PTR, SRV, TXT and A records in a
+    cache, against the cache's own estimate where it makes one"""
+    tracemalloc = optional_module('tracemalloc')
+    if tracemalloc is None:
+        return
+    tracemalloc.start()
+    cache = r.DNSCache()
+    for record in browse_records(25000):
+        cache.add(record)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("traced: %.0f B per record" % (size / 100000))
+    if hasattr(cache, 'bytes'):
+        print("estimated: %.0f B per record" % (cache.bytes / 100000))
+
+
+def bench_threads(seconds=3):
+    """One thread adding and removing records while one reads the whole
+    cache and two look records up, over 5k records"""
+    cache = r.DNSCache()
+    records = browse_records(1250)
+    for record in records:
+        cache.add(record)
+    names = [record.name for record in records if record.type == r._TYPE_A]
+    counts = {'writes': 0, 'full reads': 0, 'lookups': 0, 'errors': 0}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def run(operation, count):
+        done_count = errors = 0
+        while not done.is_set():
+            try:
+                operation(done_count)
+                done_count += 1
+            except RuntimeError:
+                errors += 1
+        with lock:
+            counts[count] += done_count
+            counts['errors'] += errors
+
+    def write(i):
+        record = records[i % len(records)]
+        cache.remove(record)
+        cache.add(record)
+
+    def read(i):
+        for entry in cache.entries():
+            pass
+
+    def look_up(i):
+        cache.get_by_details(names[i % len(names)], r._TYPE_A, r._CLASS_IN)
+
+    threads = [threading.Thread(target=run, args=args) for args in (
+        (write, 'writes'), (read, 'full reads'), (look_up, 'lookups'), (look_up, 'lookups'))]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    done.set()
+    for thread in threads:
+        thread.join()
+    print("%.0f writes/s, %.0f full reads/s, %.0f lookups/s, %d RuntimeErrors in %d s" % (
+        counts['writes'] / seconds, counts['full reads'] / seconds, counts['lookups'] / seconds,
+        counts['errors'], seconds))
+
+
+def bench_wakeups(rate=2000):
+    """50 threads resolving absent services for 2 s while unrelated
+    responses are handled alongside"""
+    resource = optional_module('resource')
+    if resource is None:
+        return
+    zc = r.Zeroconf()
+    try:
+        packet = browse_response(1)
+        done = threading.Event()
+
+        def respond():
+            due = time.time()
+            while not done.is_set():
+                zc.handle_response(r.DNSIncoming(packet))
+                due += 1 / rate
+                time.sleep(max(0, due - time.time()))
+
+        def resolve(i):
+            zc.get_service_info("_http._tcp.local.", "Absent %d._http._tcp.local." % i, 2000)
+
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        responder = threading.Thread(target=respond)
+        responder.start()
+        threads = [threading.Thread(target=resolve, args=(i,)) for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        done.set()
+        responder.join()
+        after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        zc.close()
+    print("%.2f s CPU, %d context switches" % (
+        after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime,
+        after.ru_nvcsw + after.ru_nivcsw - before.ru_nvcsw - before.ru_nivcsw))
+
+
+BENCHMARKS = [
+    ('parse', bench_parse),
+    ('names', bench_names),
+    ('build', bench_build),
+    ('cache', bench_cache),
+    ('records', bench_records),
+    ('budget', bench_budget),
+    ('threads', bench_threads),
+    ('wakeups', bench_wakeups),
+]
+
+
+def main(names):
+    benchmarks = dict(BENCHMARKS)
+    for name in names or [name for name, function in BENCHMARKS]:
+        function = benchmarks[name]
+        print("%s: %s" % (name, " ".join(function.__doc__.split())))
+        function()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,6 +2,7 @@
 from __future__ import absolute_import, division, print_function
 
 from os.path import abspath, dirname, join
+import sys
 
 from setuptools import setup
 
@@ -23,7 +24,7 @@ setup(
     long_description=readme,
     author='Paul Scott-Murphy, William McBrine, Jakub Stasiak',
     url='https://github.com/jstasiak/python-zeroconf',
-    py_modules=['zeroconf'],
+    py_modules=['zeroconf'] + (['zeroconf_asyncio'] if sys.version_info >= (3, 5) else []),
     platforms=['unix', 'linux', 'osx'],
     license='LGPL',
     zip_safe=False,
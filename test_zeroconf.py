@@ -2,10 +2,17 @@
 
 """ Unit tests for zeroconf.py """
 
+import errno
+import io
+import os
+import shutil
 import socket
 import struct
-import unittest
+import sys
+import tempfile
+import threading
 from threading import Event
+import unittest
 
 from mock import Mock
 from six import indexbytes
@@ -49,6 +56,55 @@ class PacketGeneration(unittest.TestCase):
         self.assertEqual(len(generated.questions), len(parsed.questions))
         self.assertEqual(question, parsed.questions[0])
 
+    def test_parse_own_packet_response(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_RESPONSE)
+        generated.add_answer_at_time(r.DNSService(
+            "svc.local.", r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 80, "foo.local."), 0)
+        generated.add_answer_at_time(r.DNSText(
+            "svc.local.", r._TYPE_TXT, r._CLASS_IN, r._DNS_TTL, b'\x04a=bc'), 0)
+        generated.add_answer_at_time(r.DNSAddress(
+            "foo.local.", r._TYPE_A, r._CLASS_IN, r._DNS_TTL, socket.inet_aton("10.0.1.2")), 0)
+        parsed = r.DNSIncoming(generated.packet())
+        self.assertEqual(len(parsed.answers), 3)
+        service, text, address = parsed.answers
+        self.assertEqual(service.name, "svc.local.")
+        self.assertEqual((service.port, service.server), (80, "foo.local."))
+        self.assertEqual(text.text, b'\x04a=bc')
+        self.assertTrue(isinstance(address.address, bytes))
+        self.assertEqual(address.address, socket.inet_aton("10.0.1.2"))
+        self.assertEqual(set(a.created for a in parsed.answers), set([parsed.now]))
+
+    def test_record_equality(self):
+        first = r.DNSService("svc.local.", r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 80, "foo.local.")
+        same = r.DNSService("svc.local.", r._TYPE_SRV, r._CLASS_IN, 10, 0, 0, 80, "foo.local.")
+        other_port = r.DNSService("svc.local.", r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 81, "foo.local.")
+        other_name = r.DNSService("svc2.local.", r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 80, "foo.local.")
+        self.assertEqual(first, same)
+        self.assertEqual(hash(first), hash(same))
+        self.assertNotEqual(first, other_port)
+        self.assertNotEqual(first, other_name)
+        self.assertEqual(len(set([first, same, other_port, other_name])), 3)
+        self.assertFalse(hasattr(first, '__dict__'))
+
+    def test_parse_with_interest(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_RESPONSE)
+        generated.add_answer_at_time(r.DNSAddress(
+            "foo.local.", r._TYPE_A, r._CLASS_IN, r._DNS_TTL, socket.inet_aton("10.0.1.2")), 0)
+        generated.add_answer_at_time(r.DNSAddress(
+            "bar.local.", r._TYPE_A, r._CLASS_IN, r._DNS_TTL, socket.inet_aton("10.0.1.3")), 0)
+        generated.add_answer_at_time(r.DNSPointer(
+            "_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL, "Svc._http._tcp.local."), 0)
+        generated.add_answer_at_time(r.DNSService(
+            "Svc._http._tcp.local.", r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 80, "Foo.local."), 0)
+        packet = generated.packet()
+
+        parsed = r.DNSIncoming(packet, frozenset(["_http._tcp.local."]))
+        self.assertEqual([a.name for a in parsed.answers],
+                         ["foo.local.", "_http._tcp.local.", "Svc._http._tcp.local."])
+        parsed = r.DNSIncoming(packet, frozenset(["_ipp._tcp.local."]))
+        self.assertEqual(parsed.answers, [])
+        self.assertEqual(len(r.DNSIncoming(packet).answers), 4)
+
 
 class PacketForm(unittest.TestCase):
 
@@ -59,6 +115,13 @@ class PacketForm(unittest.TestCase):
         id = indexbytes(bytes, 0) << 8 | indexbytes(bytes, 1)
         self.assertEqual(id, 0)
 
+    def test_unicast_transaction_id(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_RESPONSE, False)
+        generated.id = 0x1234
+        bytes = generated.packet()
+        self.assertEqual(bytes[:2], b'\x12\x34')
+        self.assertEqual(generated.packet(), bytes)
+
     def test_query_header_bits(self):
         generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
         bytes = generated.packet()
@@ -95,6 +158,114 @@ class PacketForm(unittest.TestCase):
         self.assertEqual(numAdditionals, 0)
 
 
+class MultiplePackets(unittest.TestCase):
+
+    def answers(self, count):
+        return [
+            r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL,
+                         "Service %d._http._tcp.local." % i)
+            for i in xrange(count)
+        ]
+
+    def test_response_split(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+        for answer in self.answers(200):
+            generated.add_answer_at_time(answer, 0)
+        packets = generated.packets(r._MAX_MSG_TYPICAL)
+        self.assertTrue(len(packets) > 1)
+        parsed = []
+        for packet in packets:
+            self.assertTrue(len(packet) <= r._MAX_MSG_TYPICAL)
+            incoming = r.DNSIncoming(packet)
+            self.assertFalse(incoming.flags & r._FLAGS_TC)
+            parsed.extend(incoming.answers)
+        self.assertEqual(parsed, self.answers(200))
+        self.assertEqual(len(generated.packets(None)), 1)
+
+    def test_query_known_answers_truncated(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+        generated.add_question(r.DNSQuestion("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN))
+        for answer in self.answers(200):
+            generated.add_answer_at_time(answer, 0)
+        packets = [r.DNSIncoming(packet) for packet in generated.packets(512)]
+        self.assertTrue(len(packets) > 2)
+        self.assertEqual([len(p.questions) for p in packets], [1] + [0] * (len(packets) - 1))
+        self.assertEqual([bool(p.flags & r._FLAGS_TC) for p in packets],
+                         [True] * (len(packets) - 1) + [False])
+        self.assertEqual(sum(len(p.answers) for p in packets), 200)
+
+    def test_listener_waits_for_known_answers(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+        generated.add_question(r.DNSQuestion("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN))
+        for answer in self.answers(50):
+            generated.add_answer_at_time(answer, 0)
+        zeroconf = Mock()
+        listener = Listener(zeroconf)
+        for packet in generated.packets(512):
+            listener.handle_query(r.DNSIncoming(packet), "10.0.1.2", r._MDNS_PORT)
+        self.assertEqual(zeroconf.handle_query.call_count, 1)
+        msg = zeroconf.handle_query.call_args[0][0]
+        self.assertEqual(len(msg.questions), 1)
+        self.assertEqual(len(msg.answers), 50)
+
+    def test_listener_answers_held_query_when_due(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+        generated.add_question(r.DNSQuestion("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN))
+        for answer in self.answers(50):
+            generated.add_answer_at_time(answer, 0)
+        zeroconf = Mock()
+        listener = Listener(zeroconf)
+        # The follow-up packets never arrive
+        listener.handle_query(r.DNSIncoming(generated.packets(512)[0]), "10.0.1.2", r._MDNS_PORT)
+        deadline = listener.next_truncated()
+        zeroconf.reaper.notify.assert_called_once_with(deadline)
+
+        listener.flush_truncated(deadline - 1)
+        self.assertEqual(zeroconf.handle_query.call_count, 0)
+        listener.flush_truncated(deadline)
+        self.assertEqual(zeroconf.handle_query.call_count, 1)
+        self.assertEqual(listener.next_truncated(), None)
+
+    def test_listener_answers_held_query_early(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+        generated.add_question(r.DNSQuestion("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN))
+        for answer in self.answers(50):
+            generated.add_answer_at_time(answer, 0)
+        packets = generated.packets(512)
+        zeroconf = Mock()
+        zeroconf.statistics = None
+        zeroconf.interest = None
+        listener = Listener(zeroconf)
+
+        # Follow-ups do not put off the deadline of the first packet
+        listener.handle_packets([(packets[0], "10.0.1.2", r._MDNS_PORT)])
+        deadline = listener.next_truncated()
+        listener.handle_packets([(packets[1], "10.0.1.2", r._MDNS_PORT)])
+        self.assertEqual(listener.next_truncated(), deadline)
+
+        # Nor does the query wait for it once its sender sends a packet
+        # that is not a follow-up
+        response = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+        response.add_answer_at_time(self.answers(1)[0], 0)
+        listener.handle_packets([(response.packet(), "10.0.1.3", r._MDNS_PORT)])
+        self.assertEqual(zeroconf.handle_query.call_count, 0)
+        listener.handle_packets([(response.packet(), "10.0.1.2", r._MDNS_PORT)])
+        self.assertEqual(zeroconf.handle_query.call_count, 1)
+        self.assertEqual(listener.next_truncated(), None)
+
+    def test_listener_survives_failed_answer(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+        generated.add_question(r.DNSQuestion("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN))
+        for answer in self.answers(50):
+            generated.add_answer_at_time(answer, 0)
+        zeroconf = Mock()
+        zeroconf.handle_query.side_effect = socket.error("Network is unreachable")
+        listener = Listener(zeroconf)
+        listener.handle_query(r.DNSIncoming(generated.packets(512)[0]), "10.0.1.2", r._MDNS_PORT)
+        listener.flush_truncated(listener.next_truncated())
+        self.assertEqual(zeroconf.handle_query.call_count, 1)
+
+
 class Names(unittest.TestCase):
 
     def test_long_name(self):
@@ -126,6 +297,322 @@ class Names(unittest.TestCase):
         generated.add_question(question)
         r.DNSIncoming(generated.packet())
 
+    def test_suffix_compression(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_RESPONSE)
+        answers = [
+            r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL, "A._http._tcp.local."),
+            r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL, "B._http._tcp.local."),
+            r.DNSService("B._http._tcp.local.", r._TYPE_SRV, r._CLASS_IN, r._DNS_TTL, 0, 0, 80, "b.local."),
+        ]
+        for answer in answers:
+            generated.add_answer_at_time(answer, 0)
+        packet = generated.packet()
+        self.assertEqual(packet.count(b'_http'), 1)
+        self.assertEqual(packet.count(b'local'), 1)
+        parsed = r.DNSIncoming(packet)
+        self.assertEqual(parsed.answers, answers)
+        self.assertEqual([a.name for a in parsed.answers], [a.name for a in answers])
+        self.assertEqual(parsed.answers[2].server, "b.local.")
+
+    def test_compressed_suffixes(self):
+        header = struct.pack(b'!6H', 0, 0, 3, 0, 0, 0)
+        question = struct.pack(b'!HH', r._TYPE_PTR, r._CLASS_IN)
+        packet = b''.join((
+            header,
+            b'\x01a\x01b\x05local\x00', question,
+            b'\x01c\xc0\x0e', question,
+            b'\xc0\x0c', question,
+        ))
+        parsed = r.DNSIncoming(packet)
+        self.assertEqual([q.name for q in parsed.questions],
+                         ["a.b.local.", "c.b.local.", "a.b.local."])
+        self.assertEqual(parsed.names[14], ("b.local.", 23))
+
+    def test_names_are_interned(self):
+        generated = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+        generated.add_question(r.DNSQuestion("Paired.local.", r._TYPE_SRV, r._CLASS_IN))
+        packet = generated.packet()
+        first = r.DNSIncoming(packet).questions[0]
+        second = r.DNSIncoming(packet).questions[0]
+        self.assertTrue(first.name is second.name)
+        self.assertTrue(first.key is second.key)
+        self.assertEqual(first.key, "paired.local.")
+
+    def test_interned_name_type(self):
+        # Stands in for Python 2's str, which equals unicode names
+        class Name(type(u"")):
+            pass
+        name = r.intern_name(Name(u"typed.local."))
+        self.assertTrue(type(name) is Name)
+        self.assertTrue(type(r.intern_name(u"typed.local.")) is type(u""))
+
+    def test_circular_name(self):
+        header = struct.pack(b'!6H', 0, 0, 1, 0, 0, 0)
+        packet = header + b'\x01a\xc0\x0c' + struct.pack(b'!HH', r._TYPE_PTR, r._CLASS_IN)
+        self.assertRaises(r.IncomingDecodeError, r.DNSIncoming, packet)
+
+
+class TestDNSCache(unittest.TestCase):
+
+    def test_add_get_remove(self):
+        cache = r.DNSCache()
+        address1 = r.DNSAddress("Host.local.", r._TYPE_A, r._CLASS_IN, 1, b'a')
+        address2 = r.DNSAddress("host.local.", r._TYPE_A, r._CLASS_IN, 1, b'b')
+        service = r.DNSService("Svc._http._tcp.local.", r._TYPE_SRV, r._CLASS_IN, 1, 0, 0, 80, "host.local.")
+        for record in (address1, address2, service):
+            cache.add(record)
+        cache.add(r.DNSAddress("host.local.", r._TYPE_A, r._CLASS_IN, 1, b'a'))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(sorted(e.address for e in cache.entries_with_name("HOST.local.")), [b'a', b'b'])
+        self.assertTrue(cache.get(r.DNSAddress("host.local.", r._TYPE_A, r._CLASS_IN, 1, b'b')) is address2)
+        self.assertEqual(cache.get(r.DNSAddress("host.local.", r._TYPE_A, r._CLASS_IN, 1, b'c')), None)
+        self.assertTrue(cache.get_by_details("svc._http._tcp.local.", r._TYPE_SRV, r._CLASS_IN) is service)
+        self.assertEqual(cache.get_by_details("svc._http._tcp.local.", r._TYPE_TXT, r._CLASS_IN), None)
+
+        cache.remove(address1)
+        cache.remove(address1)
+        self.assertEqual(cache.entries_with_name("host.local."), [address2])
+        cache.remove(address2)
+        self.assertEqual(cache.entries_with_name("host.local."), [])
+        self.assertEqual(list(cache), [service])
+        self.assertEqual(cache.entries(), [service])
+
+    def test_indexes(self):
+        cache = r.DNSCache()
+        records = [
+            r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, 1, "A._http._tcp.local."),
+            r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, 1, "B._http._tcp.local."),
+            r.DNSPointer("_ipp._tcp.local.", r._TYPE_PTR, r._CLASS_IN, 1, "C._ipp._tcp.local."),
+            r.DNSPointer("_services._dns-sd._udp.local.", r._TYPE_PTR, r._CLASS_IN, 1, "_http._tcp.local."),
+            r.DNSText("_http._tcp.local.", r._TYPE_TXT, r._CLASS_IN, 1, b''),
+            r.DNSService("A._http._tcp.local.", r._TYPE_SRV, r._CLASS_IN, 1, 0, 0, 80, "a.local."),
+        ]
+        for record in records:
+            cache.add(record)
+        self.assertEqual(sorted(cache.instance_names("_HTTP._tcp.local.")),
+                         ["A._http._tcp.local.", "B._http._tcp.local."])
+        self.assertEqual(cache.instance_names("_ftp._tcp.local."), [])
+        self.assertEqual(cache.service_types(), ["_http._tcp.local."])
+        self.assertEqual(len(cache.entries_with_type(r._TYPE_PTR)), 4)
+        self.assertEqual(cache.entries_with_type(r._TYPE_SRV), [records[5]])
+        self.assertEqual(cache.entries_with_name_and_type("_http._tcp.local.", r._TYPE_TXT), [records[4]])
+        self.assertTrue(cache.get_by_details("_http._tcp.local.", r._TYPE_TXT, r._CLASS_IN) is records[4])
+
+        for record in records:
+            cache.remove(record)
+        self.assertEqual(cache.types, {})
+        self.assertEqual(cache.entries_with_type(r._TYPE_PTR), [])
+
+    def test_concurrent_readers(self):
+        cache = r.DNSCache(max_entries=500)
+        errors = []
+        done = Event()
+        # What a race on the cache's dicts, lists and heap raises, and the
+        # readers' own checks
+        race_errors = (AssertionError, LookupError, RuntimeError, TypeError, ValueError)
+
+        def write():
+            try:
+                for i in xrange(5000):
+                    record = r.DNSAddress("host%d.local." % (i % 700), r._TYPE_A, r._CLASS_IN, 1, b'a')
+                    cache.add(record)
+                    if i % 3 == 0:
+                        cache.remove(record)
+                    pointer = r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, 1,
+                                           "Svc%d._http._tcp.local." % (i % 300))
+                    cache.add(pointer)
+                    if i % 2 == 0:
+                        cache.remove(pointer)
+                    if i % 50 == 0:
+                        cache.pop_expired(r.current_time_millis() + 2000)
+            except race_errors as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+        def read():
+            try:
+                while not done.is_set():
+                    snapshot = cache.snapshot()
+                    self.assertEqual(len(set(id(e) for e in snapshot)), len(snapshot))
+                    self.assertTrue(len(snapshot) <= 501)
+                    cache.entries_with_name_and_type("_http._tcp.local.", r._TYPE_PTR)
+                    cache.get_by_details("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN)
+                    for entry in cache:
+                        cache.get(entry)
+                    cache.entries_with_type(r._TYPE_A)
+                    cache.entries_with_name("host1.local.")
+            except race_errors as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for i in xrange(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache.snapshot()), len(cache))
+
+    def test_expirations(self):
+        cache = r.DNSCache()
+        now = r.current_time_millis()
+        short = r.DNSAddress("a.local.", r._TYPE_A, r._CLASS_IN, 1, b'a')
+        refreshed = r.DNSAddress("b.local.", r._TYPE_A, r._CLASS_IN, 1, b'b')
+        removed = r.DNSAddress("c.local.", r._TYPE_A, r._CLASS_IN, 1, b'c')
+        long = r.DNSAddress("d.local.", r._TYPE_A, r._CLASS_IN, 10, b'd')
+        for record in (short, refreshed, removed, long):
+            record.created = now
+            cache.add(record)
+        self.assertEqual(cache.next_expiration(), now + 1000)
+        self.assertEqual(cache.pop_expired(now + 999), [])
+
+        refreshed.created = now + 5000
+        cache.remove(removed)
+        self.assertEqual(cache.pop_expired(now + 1000), [short])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.next_expiration(), now + 6000)
+        self.assertEqual(cache.pop_expired(now + 10000), [refreshed, long])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.next_expiration(), None)
+
+    def test_single_record_names(self):
+        cache = r.DNSCache()
+        first = r.DNSAddress("Host.local.", r._TYPE_A, r._CLASS_IN, 10, b'a')
+        second = r.DNSText("host.local.", r._TYPE_TXT, r._CLASS_IN, 10, b'\x01x')
+        cache.add(first)
+        self.assertTrue(cache.cache["host.local."] is first)
+        cache.add(second)
+        self.assertEqual(len(cache.cache["host.local."]), 2)
+        self.assertEqual(sorted(cache.entries_with_name("HOST.local."), key=lambda e: e.type),
+                         [first, second])
+        cache.remove(first)
+        self.assertTrue(cache.cache["host.local."] is second)
+        self.assertTrue(cache.get_by_details("host.local.", r._TYPE_TXT, r._CLASS_IN) is second)
+        self.assertEqual(cache.get(first), None)
+        same = r.DNSText("HOST.local.", r._TYPE_TXT, r._CLASS_IN, 20, b'\x01x')
+        cache.add(same)
+        self.assertEqual(cache.entries(), [same])
+        cache.remove(same)
+        self.assertEqual(cache.cache, {})
+        self.assertEqual(len(cache), 0)
+
+    def test_expirations_compacted(self):
+        cache = r.DNSCache()
+        records = [r.DNSAddress("host-%d.local." % i, r._TYPE_A, r._CLASS_IN, 10, b'a') for i in range(10)]
+        for i in range(1000):
+            cache.add(records[i % 10])
+            self.assertTrue(len(cache.expirations) <= 2 * len(cache))
+        # Entries due at the same time are ordered by name
+        for record in records:
+            record.created = 0
+        cache.rebuild_expirations()
+        self.assertEqual(cache.pop_expired(10000), sorted(records))
+
+    def test_bounded(self):
+        cache = r.DNSCache(max_entries=2)
+        cache.protected = frozenset(["watched.local."])
+        now = r.current_time_millis()
+        watched = r.DNSAddress("Watched.local.", r._TYPE_A, r._CLASS_IN, 1, b'a')
+        short = r.DNSAddress("short.local.", r._TYPE_A, r._CLASS_IN, 2, b'b')
+        long = r.DNSAddress("long.local.", r._TYPE_A, r._CLASS_IN, 3, b'c')
+        for record in (watched, short, long):
+            record.created = now
+            cache.add(record)
+        self.assertEqual(sorted(e.name for e in cache), ["Watched.local.", "long.local."])
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.evicted_bytes, short.cache_size())
+        self.assertEqual(cache.bytes, watched.cache_size() + long.cache_size())
+
+        cache.max_entries = None
+        cache.max_bytes = long.cache_size()
+        cache.add(short)
+        self.assertEqual(list(cache), [watched])
+        self.assertEqual(cache.evictions, 3)
+        self.assertEqual(cache.pop_expired(now + 3000), [watched])
+        self.assertEqual(cache.bytes, 0)
+
+    def test_bounded_by_protected(self):
+        cache = r.DNSCache(max_entries=2)
+        cache.protected = frozenset(["watched.local."])
+        now = r.current_time_millis()
+        for i in range(10):
+            record = r.DNSAddress("watched.local.", r._TYPE_A, r._CLASS_IN, 1 + i, str(i).encode())
+            record.created = now
+            cache.add(record)
+        self.assertEqual(len(cache), 10)
+        self.assertEqual(cache.protected_size, 10)
+        self.assertEqual(cache.evictions, 0)
+
+        # Adding another protected record only pushes it on the heap
+        heap = list(cache.expirations)
+        record = r.DNSAddress("watched.local.", r._TYPE_A, r._CLASS_IN, 20, b'last')
+        record.created = now
+        cache.add(record)
+        self.assertEqual(cache.expirations[:-1], heap)
+        self.assertTrue(cache.expirations[-1][1] is record)
+
+        # An unprotected record is evicted at once
+        other = r.DNSAddress("other.local.", r._TYPE_A, r._CLASS_IN, 30, b'o')
+        cache.add(other)
+        self.assertEqual(cache.get(other), None)
+        self.assertEqual(cache.evictions, 1)
+
+        cache.protected = frozenset()
+        self.assertEqual(cache.protected_size, 0)
+        cache.add(other)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.protected_bytes, 0)
+
+    def test_snapshot(self):
+        cache = r.DNSCache()
+        now = int(r.current_time_millis())
+        service = r.DNSService("Svc._http._tcp.local.", r._TYPE_SRV, r._CLASS_IN | r._CLASS_UNIQUE,
+                               120, 0, 0, 80, "host.local.")
+        address = r.DNSAddress("host.local.", r._TYPE_A, r._CLASS_IN, 10, b'\x0a\x00\x00\x01')
+        for record in (service, address):
+            record.created = now
+            cache.add(record)
+        snapshot = io.BytesIO()
+        cache.save(snapshot, now)
+
+        snapshot.seek(0)
+        loaded = r.DNSCache()
+        self.assertEqual(loaded.load(snapshot, now + 30000), [service])
+        record = loaded.get(service)
+        self.assertEqual(record.ttl, 90)
+        self.assertTrue(record.unique)
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual(loaded.get_confirmed("svc._http._tcp.local.", r._TYPE_SRV, r._CLASS_IN), None)
+        loaded.confirm(service)
+        self.assertTrue(loaded.get_confirmed("svc._http._tcp.local.", r._TYPE_SRV, r._CLASS_IN) is record)
+
+        self.assertRaises(ValueError, loaded.load, io.BytesIO(b'junk' * 4), now)
+        self.assertEqual(loaded.load(io.BytesIO(), now), [])
+
+    def test_snapshot_unconfirmed(self):
+        cache = r.DNSCache()
+        now = int(r.current_time_millis())
+        confirmed = r.DNSAddress("a.local.", r._TYPE_A, r._CLASS_IN, 120, b'\x0a\x00\x00\x01')
+        gone = r.DNSAddress("b.local.", r._TYPE_A, r._CLASS_IN, 120, b'\x0a\x00\x00\x02')
+        for record in (confirmed, gone):
+            record.created = now
+            cache.add(record)
+        snapshot = io.BytesIO()
+        cache.save(snapshot, now)
+
+        snapshot.seek(0)
+        loaded = r.DNSCache()
+        loaded.load(snapshot, now)
+        self.assertEqual(loaded.next_expiration(), now + r._CONFIRMATION_TIME)
+        loaded.confirm(confirmed)
+        self.assertEqual(loaded.pop_expired(now + r._CONFIRMATION_TIME - 1), [])
+        flushed = loaded.pop_expired(now + r._CONFIRMATION_TIME)
+        self.assertEqual(flushed, [gone])
+        self.assertTrue(flushed[0].is_expired(now + r._CONFIRMATION_TIME))
+        self.assertEqual(list(loaded), [confirmed])
+        self.assertEqual(loaded.unconfirmed, {})
+        self.assertTrue(loaded.next_expiration() > now + r._CONFIRMATION_TIME)
+
 
 class Framework(unittest.TestCase):
 
@@ -133,6 +620,594 @@ class Framework(unittest.TestCase):
         rv = r.Zeroconf()
         rv.close()
 
+    def test_response_cache(self):
+        rv = r.Zeroconf()
+        try:
+            rv.send = Mock()
+            info = ServiceInfo(
+                "_http._tcp.local.", "xxxyyy._http._tcp.local.",
+                socket.inet_aton("10.0.1.2"), 80, 0, 0, {'path': '/~paulsm/'}, "ash-2.local.")
+            rv.services[info.name.lower()] = info
+            rv.servicetypes[info.type] = 1
+
+            query = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+            query.add_question(r.DNSQuestion(info.name, r._TYPE_SRV, r._CLASS_IN))
+            packet = query.packet()
+
+            rv.handle_query(r.DNSIncoming(packet), r._MDNS_ADDR, r._MDNS_PORT)
+            rv.handle_query(r.DNSIncoming(packet), r._MDNS_ADDR, r._MDNS_PORT)
+            first, second = [call[0][0] for call in rv.send.call_args_list]
+            self.assertTrue(first is second)
+
+            info.port = 8080
+            rv.handle_query(r.DNSIncoming(packet), r._MDNS_ADDR, r._MDNS_PORT)
+            third = rv.send.call_args[0][0]
+            self.assertFalse(third is first)
+            self.assertEqual(third.answers[0][0].port, 8080)
+
+            # Known answers bypass the cache
+            query = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+            query.add_question(r.DNSQuestion(info.name, r._TYPE_SRV, r._CLASS_IN))
+            query.add_answer_at_time(third.answers[0][0], 0)
+            rv.send.reset_mock()
+            rv.handle_query(r.DNSIncoming(query.packet()), r._MDNS_ADDR, r._MDNS_PORT)
+            self.assertFalse(rv.send.called)
+        finally:
+            rv.close()
+
+    def test_interest_in_service_types(self):
+        rv = r.Zeroconf(filter_records=True)
+        try:
+            rv.send = Mock()
+            info = ServiceInfo(
+                "_http._tcp.local.", "xxxyyy._http._tcp.local.",
+                socket.inet_aton("10.0.1.2"), 80, 0, 0, {'path': '/~paulsm/'}, "ash-2.local.")
+            rv.services[info.name.lower()] = info
+            rv.servicetypes[info.type] = 1
+            rv.update_interest()
+            self.assertTrue(r._SERVICE_TYPE_ENUMERATION_NAME in rv.interest)
+
+            query = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+            query.add_question(r.DNSQuestion(r._SERVICE_TYPE_ENUMERATION_NAME, r._TYPE_PTR, r._CLASS_IN))
+            query.add_answer_at_time(r.DNSPointer(r._SERVICE_TYPE_ENUMERATION_NAME, r._TYPE_PTR, r._CLASS_IN,
+                                                  r._DNS_TTL, info.type), 0)
+            rv.listener.handle_packets([(query.packet(), '10.0.1.3', r._MDNS_PORT)])
+            self.assertEqual([call for call in rv.send.call_args_list if call[0][0].answers], [])
+        finally:
+            rv.close()
+
+    def test_warm_start(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(directory, 'cache')
+            rv = r.Zeroconf(cache_file=cache_file)
+            rv.cache.add(r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL,
+                                      "Svc._http._tcp.local."))
+            rv.close()
+
+            added = Event()
+            listener = Mock()
+            listener.add_service.side_effect = lambda *args: added.set()
+            rv = r.Zeroconf(cache_file=cache_file)
+            try:
+                self.assertEqual(len(rv.cache.unconfirmed), 1)
+                browser = ServiceBrowser(rv, "_http._tcp.local.", listener)
+                added.wait(1)
+                browser.cancel()
+                listener.add_service.assert_called_with(rv, "_http._tcp.local.", "Svc._http._tcp.local.")
+            finally:
+                rv.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_warm_start_unanswered(self):
+        directory = tempfile.mkdtemp()
+        confirmation_time = r._CONFIRMATION_TIME
+        r._CONFIRMATION_TIME = 200
+        try:
+            cache_file = os.path.join(directory, 'cache')
+            rv = r.Zeroconf(cache_file=cache_file)
+            rv.cache.add(r.DNSPointer("_gone._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL,
+                                      "Svc._gone._tcp.local."))
+            rv.close()
+
+            removed = Event()
+            listener = Mock()
+            listener.remove_service.side_effect = lambda *args: removed.set()
+            rv = r.Zeroconf(cache_file=cache_file)
+            try:
+                browser = ServiceBrowser(rv, "_gone._tcp.local.", listener)
+                removed.wait(2)
+                browser.cancel()
+                listener.add_service.assert_called_with(rv, "_gone._tcp.local.", "Svc._gone._tcp.local.")
+                listener.remove_service.assert_called_with(rv, "_gone._tcp.local.", "Svc._gone._tcp.local.")
+                self.assertEqual(len(rv.cache), 0)
+            finally:
+                rv.close()
+        finally:
+            r._CONFIRMATION_TIME = confirmation_time
+            shutil.rmtree(directory)
+
+    def test_reaper_survives_listener_errors(self):
+        rv = r.Zeroconf()
+        try:
+            broken = Mock()
+            broken.update_record.side_effect = ValueError("listener bug")
+            reaped = Event()
+            working = Mock()
+            working.update_record.side_effect = lambda *args: reaped.set()
+            rv.add_listener(broken, r.DNSQuestion("broken.local.", r._TYPE_A, r._CLASS_IN))
+            rv.add_listener(working, r.DNSQuestion("working.local.", r._TYPE_A, r._CLASS_IN))
+
+            created = r.current_time_millis() - 2000
+            for name in ("broken.local.", "working.local."):
+                rv.cache.add(r.DNSAddress(name, r._TYPE_A, r._CLASS_IN, 1, b'\x0a\x00\x01\x02', created))
+            rv.reaper.notify()
+            reaped.wait(1)
+            self.assertTrue(reaped.is_set())
+            self.assertEqual(broken.update_record.call_count, 1)
+            self.assertTrue(rv.reaper.is_alive())
+            self.assertEqual(len(rv.cache), 0)
+        finally:
+            rv.close()
+
+    def test_unreadable_cache_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache_file = os.path.join(directory, 'cache')
+            rv = r.Zeroconf(cache_file=cache_file)
+            rv.cache.add(r.DNSPointer("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL,
+                                      "Svc._http._tcp.local."))
+            rv.close()
+            with open(cache_file, 'rb') as f:
+                snapshot = f.read()
+
+            # Another file, and a snapshot cut short
+            for data in (b'not a snapshot at all', snapshot[:-6]):
+                with open(cache_file, 'wb') as f:
+                    f.write(data)
+                rv = r.Zeroconf(cache_file=cache_file)
+                try:
+                    self.assertEqual(len(rv.cache), 0)
+                finally:
+                    rv.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_browsers_share_a_thread(self):
+        rv = r.Zeroconf()
+        try:
+            threads = threading.active_count()
+            queried = Event()
+            send = rv.send
+
+            def record_send(out, *args):
+                # The browsers' queries are soon sent together
+                if len(out.questions) == 20:
+                    queried.set()
+                send(out, *args)
+            rv.send = record_send
+
+            added = Event()
+            listener = Mock()
+            listener.add_service.side_effect = lambda *args: added.set()
+            browsers = [ServiceBrowser(rv, "_t%d._tcp.local." % i, listener) for i in range(20)]
+            self.assertEqual(threading.active_count(), threads)
+            queried.wait(2)
+            self.assertTrue(queried.is_set())
+
+            rv.handle_response(r.DNSIncoming(self.announcement("_t7._tcp.local.")))
+            added.wait(1)
+            listener.add_service.assert_called_once_with(rv, "_t7._tcp.local.", "Svc._t7._tcp.local.")
+
+            for browser in browsers:
+                browser.cancel()
+            self.assertEqual(rv.listeners, [])
+        finally:
+            rv.close()
+
+    def test_browser_thread_api(self):
+        rv = r.Zeroconf()
+        cancelled = ServiceBrowser(rv, "_a._tcp.local.", Mock())
+        closed = ServiceBrowser(rv, "_b._tcp.local.", Mock())
+        try:
+            self.assertTrue(closed.daemon)
+            self.assertEqual(closed.name, "ServiceBrowser-_b._tcp.local.")
+            cancelled.join(0.01)
+            self.assertTrue(cancelled.is_alive())
+            cancelled.cancel()
+            cancelled.join()
+            self.assertFalse(cancelled.is_alive())
+            self.assertTrue(closed.is_alive())
+        finally:
+            rv.close()
+        closed.join()
+        self.assertFalse(closed.is_alive())
+
+    def test_request_wakes_on_its_records(self):
+        rv = r.Zeroconf()
+        try:
+            type_ = "_http._tcp.local."
+            info = ServiceInfo(type_, "Svc." + type_)
+            rv.add_listener(info, r.DNSQuestion(info.name, r._TYPE_ANY, r._CLASS_IN))
+            info.changed = Event()
+
+            other = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+            other.add_answer_at_time(
+                r.DNSText("Other." + type_, r._TYPE_TXT, r._CLASS_IN, r._DNS_TTL, b'\x03a=b'), 0)
+            rv.handle_response(r.DNSIncoming(other.packet()))
+            self.assertFalse(info.changed.is_set())
+
+            registered = ServiceInfo(type_, info.name, socket.inet_aton("10.0.1.2"), 80, 0, 0,
+                                     {'a': 'b'}, "ash-2.local.")
+            out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+            for record in registered.dns_records():
+                out.add_answer_at_time(record, 0)
+            rv.handle_response(r.DNSIncoming(out.packet()))
+            self.assertTrue(info.changed.is_set())
+            rv.remove_listener(info)
+
+            # The records are cached, so a request finds them at once
+            start = r.current_time_millis()
+            found = rv.get_service_info(type_, info.name)
+            self.assertTrue(r.current_time_millis() - start < r._LISTENER_TIME)
+            self.assertEqual(found.server, "ash-2.local.")
+            self.assertEqual(found.changed, None)
+        finally:
+            rv.close()
+
+    def test_unanswerable_query_keeps_known_answers_encoded(self):
+        rv = r.Zeroconf()
+        try:
+            query = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+            query.add_question(r.DNSQuestion("_nothing._tcp.local.", r._TYPE_PTR, r._CLASS_IN))
+            query.add_answer_at_time(r.DNSPointer(
+                "_nothing._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL, "Svc._nothing._tcp.local."), 0)
+            msg = r.DNSIncoming(query.packet())
+            rv.handle_query(msg, r._MDNS_ADDR, r._MDNS_PORT)
+            self.assertEqual(msg._answers, None)
+            self.assertEqual(rv.responses, {})
+        finally:
+            rv.close()
+
+    def test_interest_with_concurrent_listeners(self):
+        rv = r.Zeroconf(filter_records=True)
+        try:
+            def churn(n):
+                name = "host%d.local." % n
+                for i in xrange(200):
+                    listener = Mock()
+                    rv.add_listener(listener, r.DNSQuestion(name, r._TYPE_A, r._CLASS_IN))
+                    rv.remove_listener(listener)
+                rv.add_listener(Mock(), r.DNSQuestion(name, r._TYPE_A, r._CLASS_IN))
+
+            threads = [threading.Thread(target=churn, args=(n,)) for n in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            expected = frozenset("host%d.local." % n for n in xrange(8))
+            self.assertEqual(rv.interest, expected)
+            self.assertEqual(rv.cache.protected, expected)
+        finally:
+            rv.close()
+
+    def test_listener_index(self):
+        rv = r.Zeroconf()
+        try:
+            ptr = Mock()
+            any_ = Mock()
+            wildcard = Mock()
+            rv.add_listener(ptr, r.DNSQuestion("_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN))
+            rv.add_listener(any_, r.DNSQuestion("Svc._http._tcp.local.", r._TYPE_ANY, r._CLASS_IN))
+            rv.add_listener(any_, r.DNSQuestion("svc._http._tcp.local.", r._TYPE_TXT, r._CLASS_IN))
+            rv.add_listener(wildcard, None)
+
+            out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+            out.add_answer_at_time(r.DNSPointer(
+                "_http._tcp.local.", r._TYPE_PTR, r._CLASS_IN, r._DNS_TTL, "Svc._http._tcp.local."), 0)
+            out.add_answer_at_time(r.DNSText(
+                "Svc._http._tcp.local.", r._TYPE_TXT, r._CLASS_IN, r._DNS_TTL, b'\x03a=b'), 0)
+            out.add_answer_at_time(r.DNSAddress(
+                "other.local.", r._TYPE_A, r._CLASS_IN, r._DNS_TTL, b'\x0a\x00\x01\x02'), 0)
+            rv.handle_response(r.DNSIncoming(out.packet()))
+
+            self.assertEqual([c[0][2].type for c in ptr.update_record.call_args_list], [r._TYPE_PTR])
+            # Once per record, however many of its questions match
+            self.assertEqual([c[0][2].type for c in any_.update_record.call_args_list], [r._TYPE_TXT])
+            self.assertEqual(wildcard.update_record.call_count, 3)
+
+            rv.remove_listener(any_)
+            rv.remove_listener(wildcard)
+            self.assertEqual(list(rv.listener_index), [("_http._tcp.local.", r._TYPE_PTR)])
+            self.assertEqual(rv.wildcard_listeners, [])
+        finally:
+            rv.close()
+
+    def test_scheduler_survives_browser_errors(self):
+        rv = r.Zeroconf()
+        try:
+            queried = Event()
+            send = rv.send
+
+            def record_send(out, *args):
+                if any(q.name == "_b._tcp.local." for q in out.questions):
+                    queried.set()
+                send(out, *args)
+            rv.send = record_send
+
+            broken = ServiceBrowser(rv, "_a._tcp.local.", Mock())
+            broken.services = Mock()
+            broken.services.values.side_effect = RuntimeError("dictionary changed size during iteration")
+            ServiceBrowser(rv, "_b._tcp.local.", Mock())
+            queried.wait(1)
+            self.assertTrue(queried.is_set())
+            self.assertTrue(rv.scheduler.is_alive())
+            self.assertTrue(broken.next_time > r.current_time_millis())
+        finally:
+            rv.close()
+
+    def test_slow_listener(self):
+        rv = r.Zeroconf()
+        try:
+            release = Event()
+            added = []
+            slow_added = Event()
+
+            def add_service(zc, type_, name):
+                release.wait(2)
+                added.append(name)
+                if len(added) == 2:
+                    slow_added.set()
+            slow = Mock()
+            slow.add_service.side_effect = add_service
+            fast_added = Event()
+            fast = Mock()
+            fast.add_service.side_effect = lambda *args: fast_added.set()
+            ServiceBrowser(rv, "_a._tcp.local.", slow)
+            ServiceBrowser(rv, "_b._tcp.local.", fast)
+
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "One", "Two")))
+            rv.handle_response(r.DNSIncoming(self.announcement("_b._tcp.local.")))
+            fast_added.wait(1)
+            self.assertTrue(fast_added.is_set())
+            self.assertEqual(added, [])
+
+            release.set()
+            slow_added.wait(1)
+            self.assertEqual(added, ["One._a._tcp.local.", "Two._a._tcp.local."])
+        finally:
+            rv.close()
+
+    def test_browser_event_burst(self):
+        executor = Mock()
+        rv = r.Zeroconf(executor=executor, max_browser_events=3, collect_stats=True)
+        try:
+            calls = []
+            listener = Mock()
+            listener.add_service.side_effect = lambda zc, type_, name: calls.append(('add', name))
+            listener.remove_service.side_effect = lambda zc, type_, name: calls.append(('remove', name))
+            browser = ServiceBrowser(rv, "_a._tcp.local.", listener)
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "1", "2")))
+            self.assertEqual(len(browser.events), 2)
+            executor.submit.assert_called_once_with(browser.dispatch)
+
+            # A service that goes before its addition is passed on is
+            # never reported
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "2", ttl=0)))
+            browser.dispatch()
+            self.assertEqual(calls, [('add', "1._a._tcp.local.")])
+
+            # One that goes and comes back is reported as both
+            del calls[:]
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "1", ttl=0)))
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "1")))
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "1", ttl=0)))
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "1")))
+            self.assertEqual(len(browser.events), 2)
+            browser.dispatch()
+            self.assertEqual(calls, [('remove', "1._a._tcp.local."), ('add', "1._a._tcp.local.")])
+
+            # Past max_browser_events the oldest events are dropped
+            del calls[:]
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "3", "4", "5", "6")))
+            self.assertEqual(len(browser.events), 3)
+            browser.dispatch()
+            self.assertEqual(calls, [('add', "%s._a._tcp.local." % name) for name in "456"])
+            self.assertEqual(browser.pending, {})
+
+            stats = rv.stats()
+            self.assertEqual(stats['browser_events'], 9)
+            self.assertEqual(stats['browser_events_coalesced'], 2)
+            self.assertEqual(stats['browser_events_dropped'], 1)
+            self.assertEqual(stats['browser_event_handling']['count'], 6)
+        finally:
+            rv.close()
+
+    def test_browser_events_without_executor(self):
+        executor = Mock()
+        executor.submit.side_effect = RuntimeError("cannot schedule new futures after shutdown")
+        rv = r.Zeroconf(executor=executor)
+        try:
+            added = Event()
+            threads = []
+            listener = Mock()
+
+            def add_service(zc, type_, name):
+                threads.append(threading.current_thread())
+                added.set()
+            listener.add_service.side_effect = add_service
+            browser = ServiceBrowser(rv, "_a._tcp.local.", listener)
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.")))
+            added.wait(1)
+            self.assertTrue(added.is_set())
+
+            added.clear()
+            rv.handle_response(r.DNSIncoming(self.announcement("_a._tcp.local.", "Other")))
+            added.wait(1)
+            self.assertTrue(added.is_set())
+            self.assertEqual(len(browser.announced), 2)
+            self.assertFalse(any(thread is rv.scheduler for thread in threads))
+        finally:
+            rv.close()
+
+    def announcement(self, type_, *names, **kwargs):
+        ttl = kwargs.get('ttl', r._DNS_TTL)
+        out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+        for name in names or ("Svc",):
+            out.add_answer_at_time(
+                r.DNSPointer(type_, r._TYPE_PTR, r._CLASS_IN, ttl, "%s.%s" % (name, type_)), 0)
+        return out.packet()
+
+    def test_engine_wakes_up(self):
+        rv = r.Zeroconf()
+        selectors = r.selectors
+        r.selectors = None
+        try:
+            fallback = r.Engine(rv)
+        finally:
+            r.selectors = selectors
+        self.assertEqual(fallback.selector, None)
+        try:
+            for engine in (rv.engine, fallback):
+                read = Event()
+                reader = Mock()
+                reader.handle_read.side_effect = lambda s: (s.recv(16), read.set())
+                sender, receiver = socket.socketpair()
+                try:
+                    engine.add_reader(reader, receiver)
+                    sender.send(b'x')
+                    read.wait(1)
+                    self.assertTrue(read.is_set())
+                    engine.del_reader(receiver)
+                finally:
+                    sender.close()
+                    receiver.close()
+        finally:
+            rv.close()
+            fallback.notify()
+        for engine in (rv.engine, fallback):
+            engine.join(1)
+            self.assertFalse(engine.is_alive())
+
+    def test_stats(self):
+        rv = r.Zeroconf()
+        try:
+            self.assertEqual(rv.statistics, None)
+            self.assertFalse('queries_answered' in rv.stats())
+        finally:
+            rv.close()
+
+        rv = r.Zeroconf(collect_stats=True)
+        try:
+            rv.send = Mock()
+            info = ServiceInfo(
+                "_http._tcp.local.", "xxxyyy._http._tcp.local.",
+                socket.inet_aton("10.0.1.2"), 80, 0, 0, {'path': '/~paulsm/'}, "ash-2.local.")
+            rv.services[info.name.lower()] = info
+            query = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+            query.add_question(r.DNSQuestion(info.name, r._TYPE_SRV, r._CLASS_IN))
+            rv.handle_query(r.DNSIncoming(query.packet()), r._MDNS_ADDR, r._MDNS_PORT)
+            query = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+            query.add_question(r.DNSQuestion(info.name, r._TYPE_SRV, r._CLASS_IN))
+            query.add_answer_at_time(info.dns_records()[1], 0)
+            rv.handle_query(r.DNSIncoming(query.packet()), r._MDNS_ADDR, r._MDNS_PORT)
+
+            rv.cache.add(info.dns_records()[2])
+            rv.cache.get_by_details(info.name, r._TYPE_TXT, r._CLASS_IN)
+            rv.cache.get_by_details(info.name, r._TYPE_SRV, r._CLASS_IN)
+
+            garbage = Mock()
+            garbage.recvfrom.side_effect = [
+                (b'\x00\x00\x80\x00\x00\x00\x00\x01' + b'\x00' * 4, ('10.0.1.3', r._MDNS_PORT)),
+                socket.error(errno.EAGAIN, 'Resource temporarily unavailable'),
+            ]
+            rv.listener.handle_read(garbage)
+
+            stats = rv.stats()
+            self.assertEqual(stats['queries_answered'], 1)
+            self.assertEqual(stats['queries_unanswered'], 1)
+            self.assertEqual(stats['answers_suppressed'], 1)
+            self.assertEqual((stats['cache_hits'], stats['cache_misses']), (1, 1))
+            self.assertEqual(stats['cache_by_type'], {'txt': 1})
+            self.assertEqual(stats['parse_errors'], 1)
+            self.assertEqual(stats['packets_in'], {'listen': 1})
+            self.assertEqual(stats['bytes_in'], {'listen': 12})
+
+            # Collecting statistics does not decode the known answers of
+            # queries
+            msg = rv.listener.parse(query.packet())
+            self.assertEqual(msg._answers, None)
+        finally:
+            rv.close()
+
+    def test_interest_counted(self):
+        rv = r.Zeroconf(filter_records=True)
+        try:
+            rv.cache.add(r.DNSAddress("ash-2.local.", r._TYPE_A, r._CLASS_IN, r._DNS_TTL,
+                                      socket.inet_aton("10.0.1.2")))
+            info = ServiceInfo(
+                "_http._tcp.local.", "xxxyyy._http._tcp.local.",
+                socket.inet_aton("10.0.1.2"), 80, 0, 0, {'path': '/~paulsm/'}, "ash-2.local.")
+            listener = Mock()
+            rv.add_listener(listener, r.DNSQuestion("ash-2.local.", r._TYPE_A, r._CLASS_IN))
+            rv.add_service_interest(info)
+            self.assertEqual(rv.interest, frozenset([
+                r._SERVICE_TYPE_ENUMERATION_NAME, "_http._tcp.local.",
+                "xxxyyy._http._tcp.local.", "ash-2.local."]))
+            self.assertEqual(rv.cache.protected_size, 1)
+
+            # A name stays while a question or service still names it
+            rv.remove_listener(listener)
+            self.assertTrue("ash-2.local." in rv.interest)
+            self.assertEqual(rv.cache.protected_size, 1)
+            rv.remove_service_interest(info)
+            self.assertEqual(rv.interest, frozenset())
+            self.assertEqual(rv.cache.protected, frozenset())
+            self.assertEqual(rv.cache.protected_size, 0)
+            self.assertEqual(rv.listener_index, {})
+        finally:
+            rv.close()
+
+    def test_interest(self):
+        rv = r.Zeroconf(filter_records=True)
+        try:
+            self.assertEqual(rv.interest, frozenset())
+            listener = Mock()
+            rv.add_listener(listener, r.DNSQuestion("Svc._http._tcp.local.", r._TYPE_ANY, r._CLASS_IN))
+            self.assertEqual(rv.interest, frozenset(["svc._http._tcp.local."]))
+            rv.add_listener(listener, None)
+            self.assertEqual(rv.interest, None)
+            self.assertEqual(rv.cache.protected, frozenset(["svc._http._tcp.local."]))
+            rv.remove_listener(listener)
+            self.assertEqual(rv.interest, frozenset())
+        finally:
+            rv.close()
+
+
+class TestServiceInfo(unittest.TestCase):
+
+    def test_dns_records_cached_until_fields_change(self):
+        info = ServiceInfo(
+            "_http._tcp.local.", "xxxyyy._http._tcp.local.",
+            socket.inet_aton("10.0.1.2"), 80, 0, 0, {'path': '/~paulsm/'}, "ash-2.local.")
+        records = info.dns_records()
+        self.assertTrue(info.dns_records() is records)
+        pointer, service, text, address = records
+        self.assertEqual(pointer.alias, "xxxyyy._http._tcp.local.")
+        self.assertEqual((service.server, service.port), ("ash-2.local.", 80))
+        self.assertEqual(text.text, info.text)
+        self.assertEqual(address.name, "ash-2.local.")
+        self.assertFalse(service.unique)
+        self.assertTrue(info.dns_records(unique=True)[1].unique)
+        self.assertEqual(info.dns_records(0)[1].ttl, 0)
+
+        info.port = 8080
+        self.assertEqual(info.dns_records()[1].port, 8080)
+
+        info.address = None
+        self.assertEqual(info.dns_records()[3], None)
+
 
 def test_integration():
     service_added = Event()
@@ -175,6 +1250,85 @@ def test_integration():
         zeroconf_browser.close()
 
 
+def test_integration_asyncio():
+    if sys.version_info < (3, 5):
+        # The asyncio API needs Python 3.5
+        return
+    import asyncio
+    from zeroconf_asyncio import AsyncZeroconf, ServiceStateChange
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    type_ = "_http._tcp.local."
+    registration_name = "xxxzzz.%s" % type_
+
+    zeroconf_browser = AsyncZeroconf()
+    zeroconf_registrar = AsyncZeroconf()
+    loop.run_until_complete(zeroconf_browser.open())
+    loop.run_until_complete(zeroconf_registrar.open())
+    browser = zeroconf_browser.browse(type_)
+
+    def next_change():
+        while True:
+            change = loop.run_until_complete(
+                asyncio.wait_for(browser.__anext__(), 2))
+            if change[1] == registration_name:
+                return change[0]
+
+    desc = {'path': '/~paulsm/'}
+    info = ServiceInfo(
+        type_, registration_name,
+        socket.inet_aton("10.0.1.2"), 80, 0, 0,
+        desc, "ash-3.local.")
+    try:
+        loop.run_until_complete(zeroconf_registrar.register_service(info))
+        assert next_change() == ServiceStateChange.Added
+        found = loop.run_until_complete(
+            zeroconf_browser.get_service_info(type_, registration_name))
+        assert found is not None
+        assert found.port == 80
+        assert found.properties == {b'path': b'/~paulsm/'}
+        loop.run_until_complete(zeroconf_registrar.unregister_service(info))
+        assert next_change() == ServiceStateChange.Removed
+    finally:
+        browser.cancel()
+        loop.run_until_complete(zeroconf_registrar.close())
+        loop.run_until_complete(zeroconf_browser.close())
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def test_asyncio_without_threads():
+    if sys.version_info < (3, 5):
+        # The asyncio API needs Python 3.5
+        return
+    import asyncio
+    from zeroconf_asyncio import AsyncZeroconf
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    zc = AsyncZeroconf()
+    try:
+        listener = Mock()
+        for call in (lambda: zc.add_service_listener("_http._tcp.local.", listener),
+                     lambda: zc.remove_service_listener(listener),
+                     lambda: ServiceBrowser(zc, "_http._tcp.local.", listener),
+                     lambda: zc.wait(10),
+                     zc.notify_all):
+            try:
+                call()
+            except NotImplementedError:
+                pass
+            else:
+                assert False, 'NotImplementedError not raised'
+        assert zc.listeners == []
+    finally:
+        loop.run_until_complete(zc.close())
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
 def test_listener_handles_closed_socket_situation_gracefully():
     error = socket.error(socket.EBADF)
     error.errno = socket.EBADF
@@ -184,3 +1338,63 @@ def test_listener_handles_closed_socket_situation_gracefully():
 
     listener = Listener(zeroconf)
     listener.handle_read(zeroconf.socket)
+
+
+def test_listener_reads_batches():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        receiver.bind(('127.0.0.1', 0))
+        receiver.setblocking(False)
+        zeroconf = Mock()
+        zeroconf.statistics = None
+        zeroconf.interest = None
+        listener = Listener(zeroconf, 4)
+
+        for i in range(6):
+            out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+            out.add_answer_at_time(
+                r.DNSText("host%d.local." % i, r._TYPE_TXT, r._CLASS_IN, 120, b'x'), 0)
+            sender.sendto(out.packet(), receiver.getsockname())
+        query = r.DNSOutgoing(r._FLAGS_QR_QUERY)
+        query.add_question(r.DNSQuestion("host.local.", r._TYPE_A, r._CLASS_IN))
+        sender.sendto(query.packet(), receiver.getsockname())
+
+        # Four packets at most are read at a time, and the responses
+        # among them are handled together
+        listener.handle_read(receiver)
+        assert zeroconf.handle_responses.call_count == 1
+        msgs = zeroconf.handle_responses.call_args[0][0]
+        assert [m.answers[0].name for m in msgs] == ["host%d.local." % i for i in range(4)]
+
+        listener.handle_read(receiver)
+        assert zeroconf.handle_responses.call_count == 2
+        assert len(zeroconf.handle_responses.call_args[0][0]) == 2
+
+        # Nothing left to read
+        listener.handle_read(receiver)
+        assert zeroconf.handle_responses.call_count == 2
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_listener_skips_corrupt_responses():
+    zeroconf = Mock()
+    zeroconf.statistics = None
+    zeroconf.interest = None
+    listener = Listener(zeroconf)
+
+    packets = []
+    for i in range(3):
+        out = r.DNSOutgoing(r._FLAGS_QR_RESPONSE | r._FLAGS_AA)
+        out.add_answer_at_time(
+            r.DNSText("host%d.local." % i, r._TYPE_TXT, r._CLASS_IN, 120, b'x'), 0)
+        packets.append(out.packet())
+    # Valid header, answer cut short
+    packets[1] = packets[1][:-4]
+
+    listener.handle_packets([(packet, '10.0.1.3', r._MDNS_PORT) for packet in packets])
+    assert zeroconf.handle_responses.call_count == 1
+    msgs = zeroconf.handle_responses.call_args[0][0]
+    assert [m.answers[0].name for m in msgs] == ["host0.local.", "host2.local."]
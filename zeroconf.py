@@ -27,20 +27,43 @@ __maintainer__ = 'Jakub Stasiak <jakub@stasiak.at>'
 __version__ = '0.16.0'
 __license__ = 'LGPL'
 
+import collections
 import enum
+import errno
+import heapq
+import itertools
 import logging
+import os
 import select
 import socket
 import struct
 import threading
 import time
-from functools import reduce
 
 import netifaces
 from six import indexbytes, int2byte, text_type
 from six.moves import xrange
 
 
+try:
+    memoryview = memoryview
+except NameError:
+    # Python 2.6 fallback: DNSIncoming slices the datagram itself
+    memoryview = None
+
+try:
+    import selectors
+except ImportError:
+    # Python 2 fallback: the Engine uses select.select
+    selectors = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 fallback: browser events are handled on threads started
+    # for them unless an executor is given
+    ThreadPoolExecutor = None
+
 try:
     NullHandler = logging.NullHandler
 except AttributeError:
@@ -73,17 +96,38 @@ _CHECK_TIME = 175
 _REGISTER_TIME = 225
 _LISTENER_TIME = 200
 _BROWSER_TIME = 500
+_BROWSER_COALESCE_TIME = 100
+_TRUNCATED_TIME = 500
+_CONFIRMATION_TIME = 10 * 1000
 
 # Some DNS constants
 
 _MDNS_ADDR = '224.0.0.251'
 _MDNS_PORT = 5353
 _DNS_PORT = 53
+_SERVICE_TYPE_ENUMERATION_NAME = "_services._dns-sd._udp.local."
 _DNS_TTL = 60 * 60  # one hour default TTL
 
-_MAX_MSG_TYPICAL = 1460  # unused
+_MAX_MSG_TYPICAL = 1460
 _MAX_MSG_ABSOLUTE = 8972
 
+_MAX_INTERNED_NAMES = 100000
+_MAX_CACHED_RESPONSES = 1000
+
+# Most packets read from the listening socket each time it is readable
+_RECEIVE_BATCH_SIZE = 64
+
+# Threads handling browser events, and the most events pending for a
+# browser
+_BROWSER_WORKERS = 4
+_MAX_BROWSER_EVENTS = 1000
+
+# Rough number of bytes a cached record takes up besides its name and
+# data: the record, its strings and its share of the cache's indexes.
+# examples/benchmark.py budget measures about 525 for browse responses on
+# 64-bit CPython 3.11, and about 390 for a cache of A records only.
+_RECORD_OVERHEAD = 520
+
 _FLAGS_QR_MASK = 0x8000  # query response mask
 _FLAGS_QR_QUERY = 0x0000  # query
 _FLAGS_QR_RESPONSE = 0x8000  # response
@@ -155,6 +199,19 @@ _TYPES = {_TYPE_A: "a",
           _TYPE_SRV: "srv",
           _TYPE_ANY: "any"}
 
+# Precompiled wire formats
+
+_STRUCT_HEADER = struct.Struct(b'!6H')
+_STRUCT_QUESTION = struct.Struct(b'!HH')
+_STRUCT_RECORD = struct.Struct(b'!HHiH')
+_STRUCT_RECORD_OUT = struct.Struct(b'!HHIH')
+_STRUCT_SHORT = struct.Struct(b'!H')
+_STRUCT_INT = struct.Struct(b'!I')
+_STRUCT_SRV = struct.Struct(b'!3H')
+_STRUCT_SNAPSHOT = struct.Struct(b'!4sQ')
+
+_SNAPSHOT_MAGIC = b'ZCC1'
+
 # utility functions
 
 
@@ -162,6 +219,73 @@ def current_time_millis():
     """Current system time in milliseconds"""
     return time.time() * 1000
 
+
+def call_logging_errors(function, *args):
+    """Calls function with args, logging rather than raising an error
+    from it.  The application's code, such as listeners and the
+    stats_callback, is called this way where a failure in it would
+    otherwise stop one of the instance's threads or timers."""
+    try:
+        function(*args)
+    except Exception as e:  # noqa: anything the application's code raises
+        log.exception('Error calling %r: %r', function, e)
+
+
+# os.replace is not in Python 2, where os.rename replaces the file on POSIX
+_replace_file = getattr(os, 'replace', os.rename)
+
+
+_interned_names = {}
+
+
+def intern_name(name):
+    """Returns the shared copy of a name, so that equal names (and cache
+    keys) parsed from different packets are the same object.  The table
+    is dropped when it grows past _MAX_INTERNED_NAMES.
+
+    There is a table per type of name: on Python 2 an ASCII str and
+    unicode name are equal, and the caller should get back the type it
+    passed."""
+    try:
+        names = _interned_names[type(name)]
+    except KeyError:
+        names = _interned_names[type(name)] = {}
+    try:
+        return names[name]
+    except KeyError:
+        if len(names) >= _MAX_INTERNED_NAMES:
+            names.clear()
+        names[name] = name
+        return name
+
+
+_encoded_names = {}
+
+
+def encode_name(name):
+    """Returns the wire form of a name as a tuple of (suffix, label)
+    pairs, one for each label, where label is the encoded label with
+    its length and suffix is the part of the name it starts.  It is
+    cached so that names we send over and over are only encoded once."""
+    try:
+        return _encoded_names[name]
+    except KeyError:
+        pass
+    parts = name.split('.')
+    if parts[-1] == '':
+        parts = parts[:-1]
+    encoded = []
+    for i, part in enumerate(parts):
+        utfstr = part.encode('utf-8')
+        if len(utfstr) > 64:
+            raise NamePartTooLongException
+        encoded.append(('.'.join(parts[i:]) + '.', int2byte(len(utfstr)) + utfstr))
+    encoded = tuple(encoded)
+    if len(_encoded_names) >= _MAX_INTERNED_NAMES:
+        _encoded_names.clear()
+    _encoded_names[name] = encoded
+    return encoded
+
 # Exceptions
 
 
@@ -188,6 +312,14 @@ class AbstractMethodException(Exception):
 class BadTypeInNameException(Exception):
     pass
 
+
+class IncomingDecodeError(Error):
+    pass
+
+
+# What decoding a malformed packet can raise
+_DECODE_ERRORS = (IncomingDecodeError, IndexError, struct.error)
+
 # implementation classes
 
 
@@ -195,9 +327,11 @@ class DNSEntry(object):
 
     """A DNS entry"""
 
+    __slots__ = ('key', 'name', 'type', 'class_', 'unique')
+
     def __init__(self, name, type, class_):
-        self.key = name.lower()
-        self.name = name
+        self.key = intern_name(name.lower())
+        self.name = intern_name(name)
         self.type = type
         self.class_ = class_ & _CLASS_MASK
         self.unique = (class_ & _CLASS_UNIQUE) != 0
@@ -209,6 +343,14 @@ class DNSEntry(object):
                 self.type == other.type and
                 self.class_ == other.class_)
 
+    def __hash__(self):
+        return hash((self.name, self.type, self.class_))
+
+    def __lt__(self, other):
+        """Orders entries by name, type and class, so that entries due
+        at the same time can be kept in a heap"""
+        return (self.name, self.type, self.class_) < (other.name, other.type, other.class_)
+
     def __ne__(self, other):
         """Non-equality test"""
         return not self.__eq__(other)
@@ -241,6 +383,8 @@ class DNSQuestion(DNSEntry):
 
     """A DNS question entry"""
 
+    __slots__ = ()
+
     def __init__(self, name, type, class_):
         # if not name.endswith(".local."):
         #    raise NonLocalNameException
@@ -259,16 +403,46 @@ class DNSQuestion(DNSEntry):
 
 class DNSRecord(DNSEntry):
 
-    """A DNS record - like a DNS entry, but has a TTL"""
+    """A DNS record - like a DNS entry, but has a TTL
+
+    created is the time the record was made at, unless one is given;
+    records read from the same packet share the time it was read at."""
 
-    def __init__(self, name, type, class_, ttl):
+    __slots__ = ('ttl', 'created')
+
+    def __init__(self, name, type, class_, ttl, created=None):
         DNSEntry.__init__(self, name, type, class_)
         self.ttl = ttl
-        self.created = current_time_millis()
+        if created is None:
+            created = current_time_millis()
+        self.created = created
 
     def __eq__(self, other):
-        """Tests equality as per DNSRecord"""
-        return isinstance(other, DNSRecord) and DNSEntry.__eq__(self, other)
+        """Tests equality on name, type, class and data"""
+        return (isinstance(other, DNSRecord) and
+                DNSEntry.__eq__(self, other) and
+                self.rdata() == other.rdata())
+
+    def __hash__(self):
+        return hash((self.name, self.type, self.class_, self.rdata()))
+
+    def details(self):
+        """Returns what tells this record apart from others with the same
+        name in the cache: its type, class and data"""
+        return (self.type, self.class_, self.rdata())
+
+    def rdata(self):
+        """Abstract method"""
+        raise AbstractMethodException
+
+    def cache_size(self):
+        """Returns roughly how many bytes of memory the record takes
+        up in a cache"""
+        rdata = self.rdata()
+        if not isinstance(rdata, tuple):
+            rdata = (rdata,)
+        return _RECORD_OVERHEAD + len(self.name) + sum(
+            len(part) for part in rdata if not isinstance(part, int))
 
     def suppressed_by(self, msg):
         """Returns true if any answer in a message can suffice for the
@@ -321,17 +495,18 @@ class DNSAddress(DNSRecord):
 
     """A DNS address record"""
 
-    def __init__(self, name, type, class_, ttl, address):
-        DNSRecord.__init__(self, name, type, class_, ttl)
+    __slots__ = ('address',)
+
+    def __init__(self, name, type, class_, ttl, address, created=None):
+        DNSRecord.__init__(self, name, type, class_, ttl, created)
         self.address = address
 
     def write(self, out):
         """Used in constructing an outgoing packet"""
         out.write_string(self.address)
 
-    def __eq__(self, other):
-        """Tests equality on address"""
-        return isinstance(other, DNSAddress) and self.address == other.address
+    def rdata(self):
+        return self.address
 
     def __repr__(self):
         """String representation"""
@@ -346,8 +521,10 @@ class DNSHinfo(DNSRecord):
 
     """A DNS host information record"""
 
-    def __init__(self, name, type, class_, ttl, cpu, os):
-        DNSRecord.__init__(self, name, type, class_, ttl)
+    __slots__ = ('cpu', 'os')
+
+    def __init__(self, name, type, class_, ttl, cpu, os, created=None):
+        DNSRecord.__init__(self, name, type, class_, ttl, created)
         self.cpu = cpu
         self.os = os
 
@@ -356,10 +533,8 @@ class DNSHinfo(DNSRecord):
         out.write_string(self.cpu)
         out.write_string(self.oso)
 
-    def __eq__(self, other):
-        """Tests equality on cpu and os"""
-        return (isinstance(other, DNSHinfo) and
-                self.cpu == other.cpu and self.os == other.os)
+    def rdata(self):
+        return (self.cpu, self.os)
 
     def __repr__(self):
         """String representation"""
@@ -370,17 +545,18 @@ class DNSPointer(DNSRecord):
 
     """A DNS pointer record"""
 
-    def __init__(self, name, type, class_, ttl, alias):
-        DNSRecord.__init__(self, name, type, class_, ttl)
+    __slots__ = ('alias',)
+
+    def __init__(self, name, type, class_, ttl, alias, created=None):
+        DNSRecord.__init__(self, name, type, class_, ttl, created)
         self.alias = alias
 
     def write(self, out):
         """Used in constructing an outgoing packet"""
         out.write_name(self.alias)
 
-    def __eq__(self, other):
-        """Tests equality on alias"""
-        return isinstance(other, DNSPointer) and self.alias == other.alias
+    def rdata(self):
+        return self.alias
 
     def __repr__(self):
         """String representation"""
@@ -391,18 +567,19 @@ class DNSText(DNSRecord):
 
     """A DNS text record"""
 
-    def __init__(self, name, type_, class_, ttl, text):
+    __slots__ = ('text',)
+
+    def __init__(self, name, type_, class_, ttl, text, created=None):
         assert isinstance(text, (bytes, type(None)))
-        DNSRecord.__init__(self, name, type_, class_, ttl)
+        DNSRecord.__init__(self, name, type_, class_, ttl, created)
         self.text = text
 
     def write(self, out):
         """Used in constructing an outgoing packet"""
         out.write_string(self.text)
 
-    def __eq__(self, other):
-        """Tests equality on text"""
-        return isinstance(other, DNSText) and self.text == other.text
+    def rdata(self):
+        return self.text
 
     def __repr__(self):
         """String representation"""
@@ -416,8 +593,11 @@ class DNSService(DNSRecord):
 
     """A DNS service record"""
 
-    def __init__(self, name, type, class_, ttl, priority, weight, port, server):
-        DNSRecord.__init__(self, name, type, class_, ttl)
+    __slots__ = ('priority', 'weight', 'port', 'server')
+
+    def __init__(self, name, type, class_, ttl, priority, weight, port, server,
+                 created=None):
+        DNSRecord.__init__(self, name, type, class_, ttl, created)
         self.priority = priority
         self.weight = weight
         self.port = port
@@ -425,18 +605,11 @@ class DNSService(DNSRecord):
 
     def write(self, out):
         """Used in constructing an outgoing packet"""
-        out.write_short(self.priority)
-        out.write_short(self.weight)
-        out.write_short(self.port)
+        out.write_string(_STRUCT_SRV.pack(self.priority, self.weight, self.port))
         out.write_name(self.server)
 
-    def __eq__(self, other):
-        """Tests equality on priority, weight, port and server"""
-        return (isinstance(other, DNSService) and
-                self.priority == other.priority and
-                self.weight == other.weight and
-                self.port == other.port and
-                self.server == other.server)
+    def rdata(self):
+        return (self.priority, self.weight, self.port, self.server)
 
     def __repr__(self):
         """String representation"""
@@ -445,14 +618,29 @@ class DNSService(DNSRecord):
 
 class DNSIncoming(object):
 
-    """Object representation of an incoming DNS packet"""
+    """Object representation of an incoming DNS packet
+
+    Fields are read in place from a memoryview of the datagram with
+    precompiled structs; bytes are only copied out for records that
+    are kept.
+
+    Only the header and questions are read up front. The answers,
+    authorities and additionals are decoded the first time answers is
+    accessed."""
+
+    def __init__(self, data, interest=None):
+        """Constructor from string holding bytes of packet
 
-    def __init__(self, data):
-        """Constructor from string holding bytes of packet"""
+        interest: optional set of lowercased names; records for other
+                  names are skipped unless a kept record points at them"""
         self.offset = 0
         self.data = data
+        self.view = data if memoryview is None else memoryview(data)
+        self.now = current_time_millis()
+        self.interest = interest
+        self.names = {}
         self.questions = []
-        self.answers = []
+        self._answers = None
         self.num_questions = 0
         self.num_answers = 0
         self.num_authorities = 0
@@ -460,31 +648,38 @@ class DNSIncoming(object):
 
         self.read_header()
         self.read_questions()
-        self.read_others()
+
+    @property
+    def answers(self):
+        if self._answers is None:
+            self._answers = []
+            self.read_others()
+        return self._answers
 
     def unpack(self, format):
-        length = struct.calcsize(format)
-        info = struct.unpack(format, self.data[self.offset:self.offset + length])
-        self.offset += length
+        if not isinstance(format, struct.Struct):
+            format = struct.Struct(format)
+        info = format.unpack_from(self.data, self.offset)
+        self.offset += format.size
         return info
 
     def read_header(self):
         """Reads header portion of packet"""
         (self.id, self.flags, self.num_questions, self.num_answers,
-         self.num_quthorities, self.num_additionals) = self.unpack(b'!6H')
+         self.num_quthorities, self.num_additionals) = self.unpack(_STRUCT_HEADER)
 
     def read_questions(self):
         """Reads questions section of packet"""
         for i in xrange(self.num_questions):
             name = self.read_name()
-            type, class_ = self.unpack(b'!HH')
+            type, class_ = self.unpack(_STRUCT_QUESTION)
 
             question = DNSQuestion(name, type, class_)
             self.questions.append(question)
 
     def read_int(self):
         """Reads an integer from the packet"""
-        return self.unpack(b'!I')[0]
+        return self.unpack(_STRUCT_INT)[0]
 
     def read_character_string(self):
         """Reads a character string from the packet"""
@@ -494,46 +689,100 @@ class DNSIncoming(object):
 
     def read_string(self, length):
         """Reads a string of a given length from the packet"""
-        info = self.data[self.offset:self.offset + length]
+        info = self.read_bytes(self.offset, length)
         self.offset += length
         return info
 
+    def read_bytes(self, offset, length):
+        """Returns a copy of length bytes of the packet from offset"""
+        data = self.view[offset:offset + length]
+        if isinstance(data, bytes):
+            return data
+        return data.tobytes()
+
     def read_unsigned_short(self):
         """Reads an unsigned short from the packet"""
-        return self.unpack(b'!H')[0]
+        return self.unpack(_STRUCT_SHORT)[0]
 
     def read_others(self):
         """Reads the answers, authorities and additionals section of the
-        packet"""
+        packet
+
+        With an interest set, the record headers are scanned first and
+        only records named in the set are decoded, along with any records
+        whose names those point at (PTR alias, SRV server)."""
         n = self.num_answers + self.num_authorities + self.num_additionals
+        if self.interest is None:
+            for i in xrange(n):
+                domain = self.read_name()
+                type, class_, ttl, length = self.unpack(_STRUCT_RECORD)
+                rec = self.read_record(domain, type, class_, ttl, length)
+                if rec is not None:
+                    self._answers.append(rec)
+            return
+
+        headers = []
         for i in xrange(n):
             domain = self.read_name()
-            type, class_, ttl, length = self.unpack(b'!HHiH')
-
-            rec = None
-            if type == _TYPE_A:
-                rec = DNSAddress(domain, type, class_, ttl, self.read_string(4))
-            elif type == _TYPE_CNAME or type == _TYPE_PTR:
-                rec = DNSPointer(domain, type, class_, ttl, self.read_name())
-            elif type == _TYPE_TXT:
-                rec = DNSText(domain, type, class_, ttl, self.read_string(length))
-            elif type == _TYPE_SRV:
-                rec = DNSService(domain, type, class_, ttl,
-                                 self.read_unsigned_short(), self.read_unsigned_short(),
-                                 self.read_unsigned_short(), self.read_name())
-            elif type == _TYPE_HINFO:
-                rec = DNSHinfo(domain, type, class_, ttl,
-                               self.read_character_string(), self.read_character_string())
-            elif type == _TYPE_AAAA:
-                rec = DNSAddress(domain, type, class_, ttl, self.read_string(16))
-            else:
-                # Try to ignore types we don't know about
-                # Skip the payload for the resource record so the next
-                # records can be parsed correctly
-                self.offset += length
-
-            if rec is not None:
-                self.answers.append(rec)
+            type, class_, ttl, length = self.unpack(_STRUCT_RECORD)
+            headers.append((domain, domain.lower(), type, class_, ttl, length, self.offset))
+            self.offset += length
+        end = self.offset
+
+        # The interest set is changed in place as listeners come and go,
+        # so it is only tested, never iterated or copied
+        interest = self.interest
+        followed = set()
+        kept = {}
+        changed = True
+        while changed:
+            changed = False
+            for i, (domain, key, type, class_, ttl, length, offset) in enumerate(headers):
+                if i in kept or (key not in interest and key not in followed):
+                    continue
+                self.offset = offset
+                rec = kept[i] = self.read_record(domain, type, class_, ttl, length)
+                if type == _TYPE_CNAME or type == _TYPE_PTR:
+                    target = rec.alias.lower()
+                elif type == _TYPE_SRV:
+                    target = rec.server.lower()
+                else:
+                    continue
+                if target not in interest and target not in followed:
+                    followed.add(target)
+                    changed = True
+
+        for i in sorted(kept):
+            if kept[i] is not None:
+                self._answers.append(kept[i])
+        self.offset = end
+
+    def read_record(self, domain, type, class_, ttl, length):
+        """Reads the data of a record whose header has been read, leaving
+        the offset after it.  Returns None for unknown types."""
+        end = self.offset + length
+        now = self.now
+        rec = None
+        if type == _TYPE_A:
+            rec = DNSAddress(domain, type, class_, ttl, self.read_string(4), now)
+        elif type == _TYPE_CNAME or type == _TYPE_PTR:
+            rec = DNSPointer(domain, type, class_, ttl, self.read_name(), now)
+        elif type == _TYPE_TXT:
+            rec = DNSText(domain, type, class_, ttl, self.read_string(length), now)
+        elif type == _TYPE_SRV:
+            priority, weight, port = self.unpack(_STRUCT_SRV)
+            rec = DNSService(domain, type, class_, ttl,
+                             priority, weight, port, self.read_name(), now)
+        elif type == _TYPE_HINFO:
+            rec = DNSHinfo(domain, type, class_, ttl,
+                           self.read_character_string(), self.read_character_string(), now)
+        elif type == _TYPE_AAAA:
+            rec = DNSAddress(domain, type, class_, ttl, self.read_string(16), now)
+        # Types we don't know about are skipped, as is anything left
+        # over in the payload, so the next records can be parsed
+        # correctly
+        self.offset = end
+        return rec
 
     def is_query(self):
         """Returns true if this is a query"""
@@ -545,47 +794,68 @@ class DNSIncoming(object):
 
     def read_utf(self, offset, length):
         """Reads a UTF-8 string of a given length from the packet"""
-        return text_type(self.data[offset:offset + length], 'utf-8', 'replace')
+        return self.read_bytes(offset, length).decode('utf-8', 'replace')
 
     def read_name(self):
-        """Reads a domain name from the packet"""
-        result = ''
+        """Reads a domain name from the packet
+
+        Every label offset is remembered for the rest of the packet with
+        the name suffix starting there and the offset just past that run
+        of labels, so a name is decoded only once whether it is reached
+        through a compression pointer or read in place."""
+        names = self.names
+        labels = []
+        offsets = []
+        ends = []
+        suffix = ''
         off = self.offset
         next = -1
         first = off
 
         while True:
+            if off in names:
+                suffix, end = names[off]
+                break
             length = indexbytes(self.data, off)
-            off += 1
             if length == 0:
+                end = off + 1
                 break
             t = length & 0xC0
             if t == 0x00:
-                result = ''.join((result, self.read_utf(off, length) + '.'))
-                off += length
+                offsets.append(off)
+                labels.append(self.read_utf(off + 1, length))
+                off += 1 + length
             elif t == 0xC0:
+                end = off + 2
                 if next < 0:
-                    next = off + 1
-                off = ((length & 0x3F) << 8) | indexbytes(self.data, off)
+                    next = end
+                ends.extend([end] * (len(labels) - len(ends)))
+                off = ((length & 0x3F) << 8) | indexbytes(self.data, off + 1)
                 if off >= first:
-                    # TODO raise more specific exception
-                    raise Exception("Bad domain name (circular) at %s" % (off,))
+                    raise IncomingDecodeError("Bad domain name (circular) at %s" % (off,))
                 first = off
             else:
-                # TODO raise more specific exception
-                raise Exception("Bad domain name at %s" % (off,))
+                raise IncomingDecodeError("Bad domain name at %s" % (off,))
 
+        ends.extend([end] * (len(labels) - len(ends)))
         if next >= 0:
             self.offset = next
         else:
-            self.offset = off
+            self.offset = end
 
-        return result
+        for i in xrange(len(labels) - 1, -1, -1):
+            suffix = intern_name(''.join((labels[i], '.', suffix)))
+            names[offsets[i]] = (suffix, ends[i])
+        return suffix
 
 
 class DNSOutgoing(object):
 
-    """Object representation of an outgoing packet"""
+    """Object representation of an outgoing packet
+
+    The packet is written into a single bytearray.  Room for the header
+    and for each record's data length is reserved up front and filled
+    in with pack_into once the size is known."""
 
     def __init__(self, flags, multicast=True):
         self.finished = False
@@ -593,8 +863,9 @@ class DNSOutgoing(object):
         self.multicast = multicast
         self.flags = flags
         self.names = {}
-        self.data = []
-        self.size = 12
+        self.data = bytearray(_STRUCT_HEADER.size)
+        self.built = {}
+        self.suppressed = 0
 
         self.questions = []
         self.answers = []
@@ -606,9 +877,12 @@ class DNSOutgoing(object):
         self.questions.append(record)
 
     def add_answer(self, inp, record):
-        """Adds an answer"""
+        """Adds an answer, unless a known answer in the incoming
+        message suppresses it"""
         if not record.suppressed_by(inp):
             self.add_answer_at_time(record, 0)
+        else:
+            self.suppressed += 1
 
     def add_answer_at_time(self, record, now):
         """Adds an answer if if does not expire by a certain time"""
@@ -624,32 +898,29 @@ class DNSOutgoing(object):
         """Adds an additional answer"""
         self.additionals.append(record)
 
+    @property
+    def size(self):
+        return len(self.data)
+
     def pack(self, format, value):
-        self.data.append(struct.pack(format, value))
-        self.size += struct.calcsize(format)
+        self.data += struct.pack(format, value)
 
     def write_byte(self, value):
         """Writes a single byte to the packet"""
-        self.pack(b'!c', int2byte(value))
-
-    def insert_short(self, index, value):
-        """Inserts an unsigned short in a certain position in the packet"""
-        self.data.insert(index, struct.pack(b'!H', value))
-        self.size += 2
+        self.data.append(value)
 
     def write_short(self, value):
         """Writes an unsigned short to the packet"""
-        self.pack(b'!H', value)
+        self.data += _STRUCT_SHORT.pack(value)
 
     def write_int(self, value):
         """Writes an unsigned integer to the packet"""
-        self.pack(b'!I', int(value))
+        self.data += _STRUCT_INT.pack(int(value))
 
     def write_string(self, value):
         """Writes a string to the packet"""
         assert isinstance(value, bytes)
-        self.data.append(value)
-        self.size += len(value)
+        self.data += value
 
     def write_utf(self, s):
         """Writes a UTF-8 string of a given length to the packet"""
@@ -661,134 +932,596 @@ class DNSOutgoing(object):
         self.write_string(utfstr)
 
     def write_name(self, name):
-        """Writes a domain name to the packet"""
-
-        if name in self.names:
-            # Find existing instance of this name in packet
-            #
-            index = self.names[name]
-
-            # An index was found, so write a pointer to it
-            #
-            self.write_byte((index >> 8) | 0xC0)
-            self.write_byte(index & 0xFF)
-        else:
-            # No record of this name already, so write it
-            # out as normal, recording the location of the name
-            # for future pointers to it.
+        """Writes a domain name to the packet, compressing it by pointing
+        at the longest suffix of it that is already in the packet"""
+
+        names = self.names
+        for suffix, label in encode_name(name):
+            index = names.get(suffix)
+            if index is not None:
+                # This suffix is already in the packet, so write a
+                # pointer to it
+                #
+                self.data += _STRUCT_SHORT.pack(0xC000 | index)
+                return
+            # Record the location of the suffix for future pointers
+            # to it, if it is within reach of one
             #
-            self.names[name] = self.size
-            parts = name.split('.')
-            if parts[-1] == '':
-                parts = parts[:-1]
-            for part in parts:
-                self.write_utf(part)
-            self.write_byte(0)
+            index = len(self.data)
+            if index < 0x4000:
+                names[suffix] = index
+            self.data += label
+        self.write_byte(0)
 
     def write_question(self, question):
         """Writes a question to the packet"""
         self.write_name(question.name)
-        self.write_short(question.type)
-        self.write_short(question.class_)
+        self.data += _STRUCT_QUESTION.pack(question.type, question.class_)
 
     def write_record(self, record, now):
         """Writes a record (answer, authoritative answer, additional) to
         the packet"""
         self.write_name(record.name)
-        self.write_short(record.type)
         if record.unique and self.multicast:
-            self.write_short(record.class_ | _CLASS_UNIQUE)
+            class_ = record.class_ | _CLASS_UNIQUE
         else:
-            self.write_short(record.class_)
+            class_ = record.class_
         if now == 0:
-            self.write_int(record.ttl)
+            ttl = record.ttl
         else:
-            self.write_int(record.get_remaining_ttl(now))
+            ttl = record.get_remaining_ttl(now)
+        # The data length is written as zero and filled in once the data
+        # is written
+        self.data += _STRUCT_RECORD_OUT.pack(record.type, class_, int(ttl), 0)
         index = len(self.data)
-        # Adjust size for the short we will write before this record
-        #
-        self.size += 2
         record.write(self)
-        self.size -= 2
-
-        length = len(b''.join(self.data[index:]))
-        self.insert_short(index, length)  # Here is the short we adjusted for
+        _STRUCT_SHORT.pack_into(self.data, index - 2, len(self.data) - index)
 
     def packet(self):
         """Returns a string containing the packet's bytes
 
         No further parts should be added to the packet once this
         is done."""
-        if not self.finished:
-            self.finished = True
+        return self.packets(None)[0]
+
+    def packets(self, max_size=_MAX_MSG_TYPICAL):
+        """Returns a list of strings containing the bytes of as many
+        packets as are needed to keep each one within max_size bytes
+        (no limit if None).  A record that does not fit in a packet of
+        its own is sent on its own anyway.
+
+        The questions of a response are repeated in every packet.  A
+        query's known answers are spread over packets after the first
+        one, which carries the questions, and every packet but the last
+        has the TC bit set (RFC 6762 section 7.2).
+
+        No further parts should be added to the packet once this
+        is done."""
+        if max_size in self.built:
+            return self.built[max_size]
+        self.finished = True
+        is_query = (self.flags & _FLAGS_QR_MASK) == _FLAGS_QR_QUERY
+
+        items = []
+        if is_query:
+            items.extend((0, question, None) for question in self.questions)
+        items.extend((1, answer, time_) for answer, time_ in self.answers)
+        items.extend((2, authority, 0) for authority in self.authorities)
+        items.extend((3, additional, 0) for additional in self.additionals)
+
+        packets = []
+        counts = self.start_packet(is_query)
+        for section, item, time_ in items:
+            mark = len(self.data)
+            self.write_item(section, item, time_)
+            if (max_size is not None and len(self.data) > max_size and
+                    sum(counts[1:]) + (counts[0] if is_query else 0) > 0):
+                # Move the item that did not fit to a new packet
+                del self.data[mark:]
+                self.names = dict(
+                    (name, index) for name, index in self.names.items() if index < mark)
+                packets.append(self.finish_packet(counts, _FLAGS_TC if is_query else 0))
+                counts = self.start_packet(is_query)
+                self.write_item(section, item, time_)
+            counts[section] += 1
+        packets.append(self.finish_packet(counts, 0))
+
+        self.built[max_size] = packets
+        return packets
+
+    def start_packet(self, is_query):
+        """Starts writing a new packet, returning its section counts"""
+        self.data = bytearray(_STRUCT_HEADER.size)
+        self.names = {}
+        counts = [0, 0, 0, 0]
+        if not is_query:
             for question in self.questions:
                 self.write_question(question)
-            for answer, time_ in self.answers:
-                self.write_record(answer, time_)
-            for authority in self.authorities:
-                self.write_record(authority, 0)
-            for additional in self.additionals:
-                self.write_record(additional, 0)
-
-            self.insert_short(0, len(self.additionals))
-            self.insert_short(0, len(self.authorities))
-            self.insert_short(0, len(self.answers))
-            self.insert_short(0, len(self.questions))
-            self.insert_short(0, self.flags)
-            if self.multicast:
-                self.insert_short(0, 0)
-            else:
-                self.insert_short(0, self.id)
-        return b''.join(self.data)
+            counts[0] = len(self.questions)
+        return counts
 
+    def write_item(self, section, item, now):
+        if section == 0:
+            self.write_question(item)
+        else:
+            self.write_record(item, now)
 
-class DNSCache(object):
+    def finish_packet(self, counts, flags):
+        """Fills in the header of the packet being written and returns
+        its bytes"""
+        _STRUCT_HEADER.pack_into(
+            self.data, 0, 0 if self.multicast else self.id, self.flags | flags,
+            counts[0], counts[1], counts[2], counts[3])
+        return bytes(self.data)
 
-    """A cache of DNS entries"""
 
-    def __init__(self):
+class DNSCache(object):
+
+    """A cache of DNS entries
+
+    Records are held in a two-level dict: by key (the lowercased name),
+    then by (type, class, rdata), so that finding, adding and removing
+    a record does not depend on the size of the cache.  A name with a
+    single record, as most have, holds the record itself instead of a
+    dict, which would take more memory than the record.  types holds a
+    set of the records of each type, so that all the records of a type
+    are found in time proportional to their number, as are those of a
+    name and type, such as the PTR records that list the instances of a
+    service type.
+
+    A heap of (expiration time, record) indexes the records by when they
+    expire.  It is kept up to date lazily: records that were removed, or
+    whose TTL was reset, are sorted out when their entry comes up, and
+    the heap is rebuilt once such stale entries outnumber the records.
+
+    The cache can be bounded to a number of records and a rough number
+    of bytes.  When it grows past either limit the records due to expire
+    soonest are evicted first, except those whose name is in protected,
+    which the owner keeps up to date with the names its listeners
+    depend on through protect() and unprotect().  protected_size and
+    protected_bytes count the protected records, so that eviction stops
+    once only they are left.
+    evictions and evicted_bytes count what was evicted.
+
+    The cache can be saved to a snapshot and loaded back.  Records
+    loaded from a snapshot are held in unconfirmed, with the time they
+    must be confirmed by, until a response from the network refreshes
+    them, and are not offered as known answers until then.  Those that
+    are not confirmed within _CONFIRMATION_TIME ms, which gives the
+    first queries for them time to be answered, expire then (RFC 6762
+    section 10.4), so a service that went away while the snapshot was
+    on disk is not reported for the rest of its TTL.
+
+    Threads change the cache while others read it.  Changes are made
+    one at a time under lock, which readers never take.  Instead,
+    readers copy what they iterate over with a single call, such as the
+    values of a per-name dict, so they never see a dict change size
+    under them; and the whole cache is read through snapshot(), an
+    immutable tuple collected from the name index at most once per
+    generation, which every change moves on.  A snapshot during which
+    the generation moved on is collected again.  This relies on copying
+    a dict or a set being atomic, as it is in CPython.  Writers change
+    the per-name dicts in place, so adding a record costs the same
+    however many records its name holds."""
+
+    def __init__(self, max_entries=None, max_bytes=None):
         self.cache = {}
+        self.types = {}
+        self.statistics = None
+        self.lock = threading.RLock()
+        self.generation = 0
+        self.snapshots = (None, ())
+        self.size = 0
+        self.bytes = 0
+        self.expirations = []
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._protected = set()
+        self.protected_size = 0
+        self.protected_bytes = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.unconfirmed = {}
 
     def add(self, entry):
-        """Adds an entry"""
-        self.cache.setdefault(entry.key, []).append(entry)
+        """Adds an entry, replacing any entry with the same details"""
+        details = entry.details()
+        with self.lock:
+            records = self.cache.get(entry.key)
+            old = None
+            if records is None:
+                self.cache[entry.key] = entry
+            elif isinstance(records, DNSRecord):
+                if records.details() == details:
+                    old = records
+                    self.cache[entry.key] = entry
+                else:
+                    self.cache[entry.key] = {records.details(): records, details: entry}
+            else:
+                old = records.get(details)
+                records[details] = entry
+            typed = self.types.setdefault(entry.type, set())
+            if old is None:
+                self.size += 1
+                self.bytes += entry.cache_size()
+                if entry.key in self._protected:
+                    self.protected_size += 1
+                    self.protected_bytes += entry.cache_size()
+            else:
+                typed.discard(old)
+            typed.add(entry)
+            self.generation += 1
+            heapq.heappush(self.expirations, (self.expiration_time(entry), entry))
+            if self.can_evict():
+                self.evict()
+            if len(self.expirations) > 2 * self.size:
+                self.rebuild_expirations()
 
     def remove(self, entry):
         """Removes an entry"""
+        details = entry.details()
+        with self.lock:
+            records = self.cache.get(entry.key)
+            if records is None:
+                return
+            if isinstance(records, DNSRecord):
+                if records.details() != details:
+                    return
+                old = records
+                del self.cache[entry.key]
+            else:
+                old = records.pop(details, None)
+                if old is None:
+                    return
+                if len(records) == 1:
+                    self.cache[entry.key] = next(iter(records.values()))
+            typed = self.types[entry.type]
+            typed.discard(old)
+            if not typed:
+                del self.types[entry.type]
+            self.size -= 1
+            self.bytes -= entry.cache_size()
+            if entry.key in self._protected:
+                self.protected_size -= 1
+                self.protected_bytes -= entry.cache_size()
+            self.generation += 1
+            if self.unconfirmed:
+                self.unconfirmed.pop(entry, None)
+
+    def confirm(self, entry):
+        """Marks an entry as confirmed by the network"""
+        if self.unconfirmed:
+            self.unconfirmed.pop(entry, None)
+
+    def expiration_time(self, entry):
+        """Returns the time at which an entry is due to be removed: when
+        it expires, or the end of its confirmation window if it is
+        unconfirmed and that comes first"""
+        expiration = entry.get_expiration_time(100)
+        if self.unconfirmed:
+            deadline = self.unconfirmed.get(entry)
+            if deadline is not None and deadline < expiration:
+                return deadline
+        return expiration
+
+    def get_confirmed(self, name, type, class_):
+        """Gets an entry by details, like get_by_details, unless it has
+        not been confirmed since it was loaded from a snapshot"""
+        entry = self.get_by_details(name, type, class_)
+        if entry is not None and entry in self.unconfirmed:
+            return None
+        return entry
+
+    def save(self, f, now):
+        """Writes a snapshot of the entries that have not expired by now
+        to a binary file.
+
+        The snapshot is a header holding the time it was taken at,
+        followed by DNS response packets, each preceded by its length,
+        holding the entries with their remaining TTLs."""
+        out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
+        for entry in self.entries():
+            out.add_answer_at_time(entry, now)
+        f.write(_STRUCT_SNAPSHOT.pack(_SNAPSHOT_MAGIC, int(now)))
+        for packet in out.packets(_MAX_MSG_ABSOLUTE):
+            f.write(_STRUCT_SHORT.pack(len(packet)))
+            f.write(packet)
+
+    def load(self, f, now):
+        """Adds the entries of a snapshot written by save, less the time
+        that has passed since, and marks them unconfirmed until
+        _CONFIRMATION_TIME ms from now.  Returns the entries that were
+        added."""
+        header = f.read(_STRUCT_SNAPSHOT.size)
+        if len(header) < _STRUCT_SNAPSHOT.size:
+            return []
+        magic, saved = _STRUCT_SNAPSHOT.unpack(header)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError("not a cache snapshot")
+        elapsed = max(0, now - saved) / 1000
+        deadline = now + _CONFIRMATION_TIME
+        loaded = []
+        while True:
+            length = f.read(_STRUCT_SHORT.size)
+            if len(length) < _STRUCT_SHORT.size:
+                break
+            packet = f.read(_STRUCT_SHORT.unpack(length)[0])
+            for entry in DNSIncoming(packet).answers:
+                entry.ttl = int(entry.ttl - elapsed)
+                if entry.ttl > 0:
+                    with self.lock:
+                        self.unconfirmed[entry] = deadline
+                        self.add(entry)
+                    loaded.append(entry)
+        return loaded
+
+    @property
+    def protected(self):
+        return self._protected
+
+    @protected.setter
+    def protected(self, names):
+        """Sets the names whose records are never evicted, and counts
+        the records the cache holds for them"""
+        with self.lock:
+            size = 0
+            bytes_ = 0
+            for name in names:
+                for entry in self.records(name):
+                    size += 1
+                    bytes_ += entry.cache_size()
+            self._protected = set(names)
+            self.protected_size = size
+            self.protected_bytes = bytes_
+
+    def protect(self, name):
+        """Adds a name to those whose records are never evicted, counting
+        only the records the cache holds for it"""
+        with self.lock:
+            if name not in self._protected:
+                self._protected.add(name)
+                for entry in self.records(name):
+                    self.protected_size += 1
+                    self.protected_bytes += entry.cache_size()
+
+    def unprotect(self, name):
+        """Removes a name from those whose records are never evicted"""
+        with self.lock:
+            if name in self._protected:
+                self._protected.remove(name)
+                for entry in self.records(name):
+                    self.protected_size -= 1
+                    self.protected_bytes -= entry.cache_size()
+
+    def over_limit(self):
+        """Returns true if the cache holds more than it is allowed to"""
+        return ((self.max_entries is not None and
+                 self.size > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes))
+
+    def can_evict(self):
+        """Returns true if the cache is over a limit and holds records
+        that are not protected"""
+        return self.size > self.protected_size and self.over_limit()
+
+    def evict(self):
+        """Evicts the unprotected entries due to expire soonest until
+        the cache is within its limits, or only protected entries are
+        left"""
+        with self.lock:
+            heap = self.expirations
+            kept = []
+            while heap and self.can_evict():
+                when, entry = heapq.heappop(heap)
+                if self.get(entry) is not entry:
+                    continue
+                expiration = self.expiration_time(entry)
+                if expiration > when:
+                    heapq.heappush(heap, (expiration, entry))
+                elif entry.key in self.protected:
+                    kept.append((when, entry))
+                else:
+                    self.remove(entry)
+                    self.evictions += 1
+                    self.evicted_bytes += entry.cache_size()
+            for item in kept:
+                heapq.heappush(heap, item)
+
+    def next_expiration(self):
+        """Returns the earliest time at which an entry may expire, or
+        None if the cache is empty"""
         try:
-            list_ = self.cache[entry.key]
-            list_.remove(entry)
-        except (KeyError, ValueError):
-            pass
+            return self.expirations[0][0]
+        except IndexError:
+            return None
+
+    def pop_expired(self, now):
+        """Removes and returns the entries that have expired by now"""
+        expired = []
+        with self.lock:
+            heap = self.expirations
+            while heap and heap[0][0] <= now:
+                when, entry = heapq.heappop(heap)
+                if self.get(entry) is not entry:
+                    continue
+                expiration = self.expiration_time(entry)
+                if expiration > now:
+                    heapq.heappush(heap, (expiration, entry))
+                else:
+                    if not entry.is_expired(now):
+                        # Nothing has confirmed it since it was loaded,
+                        # so it expires now, for listeners to see
+                        entry.ttl = 0
+                    self.remove(entry)
+                    expired.append(entry)
+        return expired
+
+    def rebuild_expirations(self):
+        """Drops the heap entries of records that are gone"""
+        with self.lock:
+            heap = [(self.expiration_time(entry), entry) for entry in self.snapshot()]
+            heapq.heapify(heap)
+            self.expirations = heap
 
     def get(self, entry):
         """Gets an entry by key.  Will return None if there is no
-        matching entry."""
-        try:
-            list_ = self.cache[entry.key]
-            return list_[list_.index(entry)]
-        except (KeyError, ValueError):
+        matching entry.
+
+        A record is matched on its data as well; a question or other
+        plain entry matches the first record of its type and class."""
+        records = self.cache.get(entry.key)
+        if records is None:
             return None
+        if isinstance(entry, DNSRecord):
+            if isinstance(records, DNSRecord):
+                if records.details() == entry.details():
+                    return records
+                return None
+            return records.get(entry.details())
+        if isinstance(records, DNSRecord):
+            records = (records,)
+        else:
+            records = list(records.values())
+        for record in records:
+            if record.type == entry.type and record.class_ == entry.class_:
+                return record
+        return None
+
+    def records(self, key):
+        """Returns a list of the entries whose key is key"""
+        records = self.cache.get(key)
+        if records is None:
+            return []
+        if isinstance(records, DNSRecord):
+            return [records]
+        return list(records.values())
 
     def get_by_details(self, name, type, class_):
         """Gets an entry by details.  Will return None if there is
         no matching entry."""
         entry = DNSEntry(name, type, class_)
-        return self.get(entry)
+        entry = self.get(entry)
+        if self.statistics is not None:
+            self.statistics.count('cache_misses' if entry is None else 'cache_hits')
+        return entry
 
     def entries_with_name(self, name):
         """Returns a list of entries whose key matches the name."""
-        try:
-            return self.cache[name]
-        except KeyError:
-            return []
+        return self.records(name.lower())
+
+    def entries_with_name_and_type(self, name, type):
+        """Returns a list of entries whose key matches the name and
+        whose type matches the type."""
+        return [record for record in self.records(name.lower()) if record.type == type]
+
+    def entries_with_type(self, type):
+        """Returns a list of all entries of a type"""
+        return list(self.types.get(type, ()))
+
+    def instance_names(self, type_):
+        """Returns the names of the instances of a service type, from the
+        PTR records for the type"""
+        return [record.alias for record in self.entries_with_name_and_type(type_, _TYPE_PTR)]
+
+    def service_types(self):
+        """Returns the service types that have been enumerated with
+        _services._dns-sd._udp.local."""
+        return self.instance_names(_SERVICE_TYPE_ENUMERATION_NAME)
+
+    def snapshot(self):
+        """Returns a tuple of all entries as they were at one time.  It
+        is only built again once the cache has changed."""
+        generation, entries = self.snapshots
+        if generation == self.generation:
+            return entries
+        for attempt in range(3):
+            generation = self.generation
+            entries = self.collect()
+            if generation == self.generation:
+                break
+        else:
+            with self.lock:
+                generation = self.generation
+                entries = self.collect()
+        self.snapshots = (generation, entries)
+        return entries
+
+    def collect(self):
+        """Returns a tuple of the entries in the name index"""
+        entries = []
+        for records in list(self.cache.values()):
+            if isinstance(records, DNSRecord):
+                entries.append(records)
+            else:
+                entries.extend(list(records.values()))
+        return tuple(entries)
 
     def entries(self):
         """Returns a list of all entries"""
-        if not self.cache:
-            return []
-        else:
-            return reduce(lambda a, b: a + b, self.cache.values())
+        return list(self.snapshot())
+
+    def __iter__(self):
+        """Iterates over a snapshot of all entries"""
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return self.size
+
+
+class Statistics(object):
+
+    """Counters kept by a Zeroconf instance that collects statistics.
+
+    A counter is named by a string, or by a (name, label) pair for
+    counters kept apart by socket.  Timings are kept as a count, a
+    total and a maximum in milliseconds."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, amount=1):
+        """Adds to a counter"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def time(self, name, elapsed):
+        """Records a timing in milliseconds"""
+        with self.lock:
+            count, total, longest = self.timings.get(name, (0, 0, 0))
+            self.timings[name] = (count + 1, total + elapsed, max(longest, elapsed))
+
+    def as_dict(self):
+        """Returns the counters and timings in a dict.  Counters kept by
+        socket are given as a dict of label to count."""
+        result = {}
+        with self.lock:
+            for name, value in self.counters.items():
+                if isinstance(name, tuple):
+                    name, label = name
+                    result.setdefault(name, {})[label] = value
+                else:
+                    result[name] = value
+            for name, (count, total, longest) in self.timings.items():
+                result[name] = {'count': count, 'mean': total / count, 'max': longest}
+        return result
+
+
+def new_wakeup_pair():
+    """Returns a connected pair of non-blocking sockets, the first to
+    be written to so as to wake up a thread selecting on the second"""
+    try:
+        waker, wakeup = socket.socketpair()
+    except (AttributeError, socket.error):
+        # Python 2 on Windows has no socketpair: use loopback UDP
+        wakeup = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        wakeup.bind(('127.0.0.1', 0))
+        waker = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        waker.connect(wakeup.getsockname())
+    waker.setblocking(False)
+    wakeup.setblocking(False)
+    return waker, wakeup
 
 
 class Engine(threading.Thread):
@@ -802,6 +1535,12 @@ class Engine(threading.Thread):
 
     Writers are not implemented here, because we only send short
     packets.
+
+    Sockets are watched with a selectors.DefaultSelector (epoll on
+    Linux), or select.select where the selectors module is missing.
+    Along with them the engine watches one end of a socket pair, which
+    notify() writes to, so that adding or removing a reader, or
+    closing, takes effect at once rather than after the timeout.
     """
 
     def __init__(self, zc):
@@ -811,47 +1550,88 @@ class Engine(threading.Thread):
         self.readers = {}  # maps socket to reader
         self.timeout = 5
         self.condition = threading.Condition()
+        self.waker, self.wakeup = new_wakeup_pair()
+        self.selector = None
+        if selectors is not None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.wakeup, selectors.EVENT_READ)
         self.start()
 
     def run(self):
-        while not _GLOBAL_DONE:
-            rs = self.get_readers()
-            if len(rs) == 0:
-                # No sockets to manage, but we wait for the timeout
-                # or addition of a socket
-                #
-                with self.condition:
-                    self.condition.wait(self.timeout)
-            else:
+        try:
+            while not _GLOBAL_DONE:
                 try:
-                    rr, wr, er = select.select(rs, [], [], self.timeout)
-                    for socket_ in rr:
+                    for socket_ in self.select():
+                        if socket_ is self.wakeup:
+                            self.drain_wakeup()
+                            continue
+                        reader = self.readers.get(socket_)
+                        if reader is None:
+                            continue
+                        statistics = self.zc.statistics
+                        if statistics is not None:
+                            start = current_time_millis()
                         try:
-                            self.readers[socket_].handle_read(socket_)
+                            reader.handle_read(socket_)
                         except Exception as e:  # TODO stop catching all Exceptions
                             log.exception('Unknown error, possibly benign: %r', e)
+                        if statistics is not None:
+                            statistics.time('engine_latency', current_time_millis() - start)
                 except Exception as e:  # TODO stop catching all Exceptions
-                    log.exception('Unknown error, possibly benign: %r', e)
+                    if not _GLOBAL_DONE:
+                        log.exception('Unknown error, possibly benign: %r', e)
+        finally:
+            self.close()
+
+    def select(self):
+        """Waits for sockets to be ready for reading, and returns them"""
+        if self.selector is not None:
+            return [key.fileobj for key, events in self.selector.select(self.timeout)]
+        rs = [self.wakeup] + self.get_readers()
+        rr, wr, er = select.select(rs, [], [], self.timeout)
+        return rr
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+        self.waker.close()
+        self.wakeup.close()
 
     def get_readers(self):
         result = []
         with self.condition:
-            result = self.readers.keys()
+            result = list(self.readers.keys())
         return result
 
     def add_reader(self, reader, socket):
         with self.condition:
             self.readers[socket] = reader
-            self.condition.notify()
+            if self.selector is not None:
+                self.selector.register(socket, selectors.EVENT_READ)
+        self.notify()
 
     def del_reader(self, socket):
         with self.condition:
             del(self.readers[socket])
-            self.condition.notify()
+            if self.selector is not None:
+                self.selector.unregister(socket)
+        self.notify()
 
     def notify(self):
-        with self.condition:
-            self.condition.notify()
+        """Wakes the engine up"""
+        try:
+            self.waker.send(b'x')
+        except socket.error:
+            # Either a wakeup is already pending, or the engine has
+            # stopped and closed the socket pair
+            pass
 
 
 class Listener(object):
@@ -861,25 +1641,149 @@ class Listener(object):
     to cache information as it arrives.
 
     It requires registration with an Engine object in order to have
-    the read() method called when a socket is availble for reading."""
+    the read() method called when a socket is availble for reading.
+    The socket should be non-blocking: each time it is readable, up to
+    batch_size packets are read from it, and the responses among them
+    handled together."""
 
-    def __init__(self, zc):
+    def __init__(self, zc, batch_size=_RECEIVE_BATCH_SIZE):
         self.zc = zc
+        self.batch_size = batch_size
+        self.truncated = {}
+        self.lock = threading.Lock()
 
     def handle_read(self, socket_):
-        try:
-            data, (addr, port) = socket_.recvfrom(_MAX_MSG_ABSOLUTE)
-        except socket.error as e:
-            # If the socket was closed by another thread -- which happens
-            # regularly on shutdown -- an EBADF exception is thrown here.
-            # Ignore it.
-            if e.errno == socket.EBADF:
-                return
-            else:
-                raise e
+        packets = []
+        while len(packets) < self.batch_size:
+            try:
+                data, (addr, port) = socket_.recvfrom(_MAX_MSG_ABSOLUTE)
+            except socket.error as e:
+                # If the socket was closed by another thread -- which happens
+                # regularly on shutdown -- an EBADF exception is thrown here.
+                # Ignore it.
+                if e.errno == socket.EBADF:
+                    return
+                elif e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                else:
+                    raise e
+            packets.append((data, addr, port))
+        self.handle_packets(packets)
+
+    def handle_data(self, data, addr, port):
+        """Handles a packet received from addr and port"""
+        self.handle_packets([(data, addr, port)])
+
+    def handle_packets(self, packets):
+        """Handles a batch of (data, addr, port) packets.  Queries are
+        answered one by one, while the responses between them are passed
+        to the Zeroconf instance together."""
+        responses = []
+        for data, addr, port in packets:
+            try:
+                msg = self.parse(data)
+                if not msg.is_query():
+                    # Decode the records now, so that a corrupt one only
+                    # loses its own packet
+                    msg.answers
+            except _DECODE_ERRORS as e:
+                if self.zc.statistics is not None:
+                    self.zc.statistics.count('parse_errors')
+                log.warning('Ignoring a malformed packet from %s: %r', addr, e)
+                continue
+            if not msg.is_query():
+                responses.append(msg)
+                if not msg.flags & _FLAGS_TC:
+                    self.flush_sender(addr, port)
+                continue
+            self.flush_responses(responses)
+            responses = []
+            try:
+                self.handle_query(msg, addr, port)
+            except _DECODE_ERRORS as e:
+                # The known answers of a follow-up packet are decoded as
+                # it is merged into the query it follows
+                log.warning('Ignoring a malformed query from %s: %r', addr, e)
+        self.flush_responses(responses)
+
+    def flush_responses(self, responses):
+        if responses:
+            self.zc.handle_responses(responses)
+
+    def parse(self, data):
+        """Parses the header and questions of a packet.  The records of
+        a query are left to be decoded if and when they are needed."""
         self.data = data
-        msg = DNSIncoming(data)
-        if msg.is_query():
+        statistics = self.zc.statistics
+        if statistics is not None:
+            statistics.count(('packets_in', 'listen'))
+            statistics.count(('bytes_in', 'listen'), len(data))
+        return DNSIncoming(data, self.zc.interest)
+
+    def handle_query(self, msg, addr, port):
+        """Answers a query once all of its known answers are in.
+
+        A query with the TC bit set is followed by packets from the same
+        sender that carry only more known answers (RFC 6762 section
+        7.2), so it is held and merged with them until one arrives
+        without the TC bit.  The 400-500 ms the RFC allows for them is
+        an upper bound: a held query is answered as soon as any packet
+        without the TC bit comes from its sender, and otherwise once
+        _TRUNCATED_TIME ms have passed since its first packet, by the
+        Zeroconf instance's reaper calling flush_truncated()."""
+        key = (addr, port)
+        with self.lock:
+            pending = self.truncated.pop(key, None)
+            if pending is not None and not msg.questions:
+                held, deadline = pending
+                held.answers.extend(msg.answers)
+                held.num_answers += msg.num_answers
+                held.flags = msg.flags
+                msg = held
+                pending = None
+            else:
+                deadline = current_time_millis() + _TRUNCATED_TIME
+            if msg.flags & _FLAGS_TC:
+                self.truncated[key] = (msg, deadline)
+        if pending is not None:
+            self.answer_query(pending[0], addr, port)
+        if msg.flags & _FLAGS_TC:
+            self.zc.reaper.notify(deadline)
+        else:
+            self.answer_query(msg, addr, port)
+
+    def next_truncated(self):
+        """Returns the time the first held query is to be answered by,
+        or None if there are none"""
+        with self.lock:
+            if not self.truncated:
+                return None
+            return min(deadline for query, deadline in self.truncated.values())
+
+    def flush_sender(self, addr, port):
+        """Answers the query held for a sender, if there is one, which
+        has sent a packet that is not one of the query's follow-ups"""
+        with self.lock:
+            pending = self.truncated.pop((addr, port), None)
+        if pending is not None:
+            self.answer_query(pending[0], addr, port)
+
+    def flush_truncated(self, now):
+        """Answers the held queries whose follow-ups have not arrived
+        by now"""
+        expired = []
+        with self.lock:
+            for key, (query, deadline) in list(self.truncated.items()):
+                if deadline <= now:
+                    del self.truncated[key]
+                    expired.append((query, key))
+        for query, (addr, port) in expired:
+            self.answer_query(query, addr, port)
+
+    def answer_query(self, msg, addr, port):
+        """Answers a query, logging rather than raising a malformed known
+        answer or a failure to send"""
+        try:
             # Always multicast responses
             #
             if port == _MDNS_PORT:
@@ -890,57 +1794,218 @@ class Listener(object):
             elif port == _DNS_PORT:
                 self.zc.handle_query(msg, addr, port)
                 self.zc.handle_query(msg, _MDNS_ADDR, _MDNS_PORT)
-        else:
-            self.zc.handle_response(msg)
+        except _DECODE_ERRORS as e:
+            log.warning('Ignoring a malformed query from %s: %r', addr, e)
+        except (socket.error, Error) as e:
+            log.warning('Could not answer a query from %s: %r', addr, e)
 
 
 class Reaper(threading.Thread):
 
     """A Reaper is used by this module to remove cache entries that
-    have expired."""
+    have expired.
+
+    It sleeps until the next entry is due to expire, as told by the
+    cache's expiration index, and is woken up early if an entry that
+    expires sooner is added, or a query held for its known answers is
+    due to be answered.  If the Zeroconf instance has a
+    cache_save_interval, it also saves the cache that often, and if it
+    has a stats_callback, calls it with its stats() every
+    stats_interval.  An error in any of these is logged, and the reaper
+    carries on with the rest."""
 
     def __init__(self, zc):
         threading.Thread.__init__(self)
         self.daemon = True
         self.zc = zc
+        self.condition = threading.Condition()
+        self.deadline = None
+        self.next_save = None
+        if zc.cache_file is not None and zc.cache_save_interval is not None:
+            self.next_save = current_time_millis() + zc.cache_save_interval
+        self.next_report = None
+        if zc.stats_callback is not None:
+            self.next_report = current_time_millis() + zc.stats_interval
         self.start()
 
     def run(self):
         while True:
-            self.zc.wait(10 * 1000)
+            with self.condition:
+                if _GLOBAL_DONE:
+                    return
+                self.deadline = self.zc.cache.next_expiration()
+                truncated = self.zc.listener.next_truncated()
+                for deadline in (self.next_save, self.next_report, truncated):
+                    if deadline is not None and (
+                            self.deadline is None or deadline < self.deadline):
+                        self.deadline = deadline
+                if self.deadline is None:
+                    self.condition.wait()
+                else:
+                    timeout = self.deadline - current_time_millis()
+                    if timeout > 0:
+                        self.condition.wait(timeout / 1000)
+                self.deadline = None
             if _GLOBAL_DONE:
                 return
             now = current_time_millis()
-            for record in self.zc.cache.entries():
-                if record.is_expired(now):
-                    self.zc.update_record(now, record)
-                    self.zc.cache.remove(record)
+            self.zc.reap(now)
+            call_logging_errors(self.zc.listener.flush_truncated, now)
+            if self.next_save is not None and self.next_save <= now:
+                call_logging_errors(self.zc.save_cache)
+                self.next_save = now + self.zc.cache_save_interval
+            if self.next_report is not None and self.next_report <= now:
+                call_logging_errors(self.zc.stats_callback, self.zc.stats())
+                self.next_report = now + self.zc.stats_interval
+
+    def notify(self, expiration=None):
+        """Wakes the reaper up, or if an expiration time is given, only
+        if it is earlier than the one the reaper is waiting for"""
+        with self.condition:
+            if (expiration is None or self.deadline is None or
+                    expiration < self.deadline):
+                self.condition.notify()
+
+
+class Scheduler(threading.Thread):
+
+    """A Scheduler is used by this module to run all the ServiceBrowsers
+    of a Zeroconf instance from one thread.
+
+    It keeps a heap of the times the browsers are next due to send a
+    query, sleeps until the first of them and then sends the queries
+    that are due.  Entries for a browser whose next_time has since
+    changed, or which has been cancelled, are skipped as they come up.
+    Listeners are never called on this thread; see dispatch().
+
+    The queries of all the browsers due within _BROWSER_COALESCE_TIME ms
+    go out as one message, with a question for each browser and their
+    known answers together, split into packets as the Zeroconf
+    instance's max_packet_size requires."""
+
+    def __init__(self, zc):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.zc = zc
+        self.condition = threading.Condition()
+        self.queries = []
+        self.sequence = itertools.count()
+        self.deadline = None
+        self.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if _GLOBAL_DONE:
+                    return
+                now = current_time_millis()
+                if not self.queries:
+                    self.condition.wait()
+                    continue
+                self.deadline = self.queries[0][0]
+                if self.deadline > now:
+                    self.condition.wait((self.deadline - now) / 1000)
+                    self.deadline = None
+                    continue
+                self.deadline = None
+                due = []
+                while self.queries and self.queries[0][0] <= now + _BROWSER_COALESCE_TIME:
+                    when, sequence, browser = heapq.heappop(self.queries)
+                    if (when == browser.next_time and not browser.done and
+                            not any(b is browser for b in due)):
+                        due.append(browser)
+            if due:
+                out = DNSOutgoing(_FLAGS_QR_QUERY)
+                for browser in due:
+                    try:
+                        browser.add_query(out, now)
+                    except RuntimeError as e:
+                        # The browser's services changed as they were read
+                        log.warning('Could not add the query of %s: %r', browser.type, e)
+                try:
+                    self.zc.send(out)
+                except (socket.error, Error, NamePartTooLongException) as e:
+                    log.warning('Could not send browser queries: %r', e)
+                for browser in due:
+                    self.schedule(browser)
+
+    def schedule(self, browser):
+        """Has a browser send its next query at its next_time"""
+        with self.condition:
+            heapq.heappush(self.queries, (browser.next_time, next(self.sequence), browser))
+            if self.deadline is None or browser.next_time < self.deadline:
+                self.condition.notify()
+
+    def dispatch(self, browser):
+        """Has a browser's pending events passed to its listener, by the
+        Zeroconf instance's executor if it has one and otherwise on a
+        thread of their own, so that a slow listener never holds up the
+        queries"""
+        executor = self.zc.executor
+        if executor is not None:
+            try:
+                executor.submit(browser.dispatch)
+                return
+            except RuntimeError:
+                # The executor has been shut down
+                pass
+        thread = threading.Thread(target=browser.dispatch, name='%s events' % browser.name)
+        thread.daemon = True
+        thread.start()
 
+    def notify(self):
+        with self.condition:
+            self.condition.notify()
 
-class ServiceBrowser(threading.Thread):
+
+class ServiceBrowser(object):
 
     """Used to browse for a service of a specific type.
 
     The listener object will have its add_service() and
     remove_service() methods called when this browser
-    discovers changes in the services availability."""
+    discovers changes in the services availability.
+
+    Browsers send their queries from the Zeroconf instance's Scheduler
+    thread.  Changes are queued as events, which one task at a time
+    passes to the listener in order, on the instance's executor, so a
+    slow listener holds up neither the queries nor other browsers.
+
+    A browser keeps only the last event pending for a service, except
+    that a removal the listener has yet to be told of stays ahead of an
+    addition that follows it, so a service that went and came back is
+    reported as removed and added again.  An addition that is followed
+    by the service's removal before it is passed on cancels out.  The
+    queue holds at most the instance's max_browser_events events: past
+    that the oldest are dropped, with a warning.
+
+    Browsers used to be threads of their own.  They keep name, daemon,
+    is_alive() and join() for callers that used them as such: a browser
+    is alive until it is cancelled or the Zeroconf instance is closed."""
 
     def __init__(self, zc, type, listener):
         """Creates a browser for a specific type"""
-        threading.Thread.__init__(self)
-        self.daemon = True
         self.zc = zc
         self.type = type
         self.listener = listener
         self.services = {}
         self.next_time = current_time_millis()
         self.delay = _BROWSER_TIME
-        self.list = []
+        self.events = collections.deque()
+        self.pending = {}
+        self.announced = set()
+        self.overflowing = False
+        self.lock = threading.Lock()
+        self.dispatching = False
+        self.name = 'ServiceBrowser-%s' % type
+        self.daemon = True
 
         self.done = False
+        self.finished = threading.Event()
 
+        scheduler = self.zc.scheduler
         self.zc.add_listener(self, DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-        self.start()
+        scheduler.schedule(self)
 
     def update_record(self, zc, now, record):
         """Callback invoked by Zeroconf when new information arrives.
@@ -954,51 +2019,128 @@ class ServiceBrowser(threading.Thread):
                     oldrecord.reset_ttl(record)
                 else:
                     del(self.services[record.alias.lower()])
-                    callback = lambda x: self.listener.remove_service(x,
-                                                                      self.type, record.alias)
-                    self.list.append(callback)
+                    self.queue_event(now, record.alias, False)
                     return
             except Exception as e:  # TODO stop catching all Exceptions
                 log.exception('Unknown error, possibly benign: %r', e)
                 if not expired:
                     self.services[record.alias.lower()] = record
-                    callback = lambda x: self.listener.add_service(x,
-                                                                   self.type, record.alias)
-                    self.list.append(callback)
+                    self.queue_event(now, record.alias, True)
 
             expires = record.get_expiration_time(75)
             if expires < self.next_time:
                 self.next_time = expires
+                self.zc.scheduler.schedule(self)
 
     def cancel(self):
         self.done = True
-        self.zc.notify_all()
-
-    def run(self):
-        while True:
-            event = None
-            now = current_time_millis()
-            if len(self.list) == 0 and self.next_time > now:
-                self.zc.wait(self.next_time - now)
-            if _GLOBAL_DONE or self.done:
+        self.zc.remove_listener(self)
+        self.finished.set()
+
+    def is_alive(self):
+        return not self.finished.is_set()
+
+    def join(self, timeout=None):
+        """Waits until the browser is cancelled or the Zeroconf instance
+        is closed"""
+        self.finished.wait(timeout)
+
+    def add_query(self, out, now):
+        """Adds the browser's question to an outgoing query, with the
+        services it knows of as known answers, and backs off the time
+        until the next one"""
+        self.next_time = now + self.delay
+        self.delay = min(20 * 1000, self.delay * 2)
+        out.add_question(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
+        # The Engine thread adds services while this runs
+        for record in list(self.services.values()):
+            if (not record.is_expired(now) and
+                    record not in self.zc.cache.unconfirmed):
+                out.add_answer_at_time(record, now)
+
+    def queue_event(self, now, name, added):
+        """Queues the addition or removal of a service for the listener,
+        merged with any event pending for the service, and has it
+        dispatched unless that is already under way"""
+        statistics = self.zc.statistics
+        key = name.lower()
+        with self.lock:
+            pending = self.pending.setdefault(key, [])
+            if pending and pending[-1][3]:
+                # A pending addition is superseded by a newer one, and
+                # cancelled by the service's removal
+                self.events.remove(pending.pop())
+                if statistics is not None:
+                    statistics.count('browser_events_coalesced')
+            if pending:
+                # The listener has a removal coming, which an addition
+                # follows and a second removal would repeat
+                repeated = not added
+            else:
+                # Otherwise the event may tell the listener nothing new
+                repeated = added == (key in self.announced)
+            if repeated:
+                if not pending:
+                    del self.pending[key]
                 return
-            now = current_time_millis()
-
-            if self.next_time <= now:
-                out = DNSOutgoing(_FLAGS_QR_QUERY)
-                out.add_question(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
-                for record in self.services.values():
-                    if not record.is_expired(now):
-                        out.add_answer_at_time(record, now)
-                self.zc.send(out)
-                self.next_time = now + self.delay
-                self.delay = min(20 * 1000, self.delay * 2)
+            event = (now, key, name, added)
+            pending.append(event)
+            self.events.append(event)
+            if statistics is not None:
+                statistics.count('browser_events')
+            limit = self.zc.max_browser_events
+            if limit is not None and len(self.events) > limit:
+                self.forget(self.events.popleft())
+                if statistics is not None:
+                    statistics.count('browser_events_dropped')
+                if not self.overflowing:
+                    self.overflowing = True
+                    log.warning('More than %d events queued for %s, dropping the oldest',
+                                limit, self.type)
+            if self.dispatching:
+                return
+            self.dispatching = True
+        self.zc.scheduler.dispatch(self)
+
+    def forget(self, event):
+        """Removes an event taken off the queue from those pending for
+        its service"""
+        pending = self.pending[event[1]]
+        pending.remove(event)
+        if not pending:
+            del self.pending[event[1]]
+
+    def dispatch(self):
+        """Calls the listener for the events queued so far, and those
+        queued while it does"""
+        statistics = self.zc.statistics
+        while True:
+            with self.lock:
+                if not self.events or self.done or _GLOBAL_DONE:
+                    self.dispatching = False
+                    self.overflowing = False
+                    return
+                event = self.events.popleft()
+                self.forget(event)
+                queued, key, name, added = event
+                if added:
+                    self.announced.add(key)
+                else:
+                    self.announced.discard(key)
+            if statistics is not None:
+                start = current_time_millis()
+                statistics.time('browser_event_wait', start - queued)
+            if added:
+                call_logging_errors(self.listener.add_service, self.zc, self.type, name)
+            else:
+                call_logging_errors(self.listener.remove_service, self.zc, self.type, name)
+            if statistics is not None:
+                statistics.time('browser_event_handling', current_time_millis() - start)
 
-            if len(self.list) > 0:
-                event = self.list.pop(0)
 
-            if event is not None:
-                event(self.zc)
+_SERVICE_INFO_FIELDS = frozenset((
+    'type', 'name', 'address', 'port', 'weight', 'priority', 'server', 'text',
+))
 
 
 class ServiceInfo(object):
@@ -1032,11 +2174,43 @@ class ServiceInfo(object):
         else:
             self.server = name
         self._set_properties(properties)
+        self.changed = None
+
+    def __setattr__(self, name, value):
+        """Drops the cached records whenever a field they are made from
+        changes"""
+        object.__setattr__(self, name, value)
+        if name in _SERVICE_INFO_FIELDS:
+            object.__setattr__(self, '_records', {})
 
     @property
     def properties(self):
         return self._properties
 
+    def dns_records(self, ttl=_DNS_TTL, unique=False):
+        """Returns the PTR, SRV and TXT records of this service and the A
+        record of its server (None without an address), with the given
+        TTL and, for all but the PTR record, the cache flush bit if
+        unique is set.
+
+        The records are kept until one of the fields they are made from
+        changes, so answering for a registered service does not build
+        or encode them again."""
+        key = (ttl, unique)
+        records = self._records.get(key)
+        if records is None:
+            class_ = _CLASS_IN | _CLASS_UNIQUE if unique else _CLASS_IN
+            records = (
+                DNSPointer(self.type, _TYPE_PTR, _CLASS_IN, ttl, self.name),
+                DNSService(self.name, _TYPE_SRV, class_, ttl, self.priority,
+                           self.weight, self.port, self.server),
+                DNSText(self.name, _TYPE_TXT, class_, ttl, self.text),
+                DNSAddress(self.server, _TYPE_A, class_, ttl, self.address)
+                if self.address else None,
+            )
+            self._records[key] = records
+        return records
+
     def _set_properties(self, properties):
         """Sets properties and text of this info from a dictionary"""
         if isinstance(properties, dict):
@@ -1109,12 +2283,15 @@ class ServiceInfo(object):
         return self.name
 
     def update_record(self, zc, now, record):
-        """Updates service information from a DNS record"""
+        """Updates service information from a DNS record, and sets the
+        changed event, if there is one, when the record is about this
+        service"""
         if record is not None and not record.is_expired(now):
             if record.type == _TYPE_A:
                 # if record.name == self.name:
                 if record.name == self.server:
                     self.address = record.address
+                    self.set_changed()
             elif record.type == _TYPE_SRV:
                 if record.name == self.name:
                     self.server = record.server
@@ -1124,52 +2301,70 @@ class ServiceInfo(object):
                     # self.address = None
                     self.update_record(zc, now,
                                        zc.cache.get_by_details(self.server, _TYPE_A, _CLASS_IN))
+                    self.set_changed()
             elif record.type == _TYPE_TXT:
                 if record.name == self.name:
                     self._set_text(record.text)
+                    self.set_changed()
+
+    def set_changed(self):
+        changed = self.changed
+        if changed is not None:
+            changed.set()
 
     def request(self, zc, timeout):
         """Returns true if the service could be discovered on the
         network, and updates this object with details discovered.
+
+        The calling thread waits on an event of its own, which only
+        records about this service set.
         """
         now = current_time_millis()
         delay = _LISTENER_TIME
         next = now + delay
         last = now + timeout
         result = False
+        server = None
+        self.changed = threading.Event()
         try:
             zc.add_listener(self, DNSQuestion(self.name, _TYPE_ANY, _CLASS_IN))
             while (self.server is None or self.address is None or
                    self.text is None):
                 if last <= now:
                     return False
+                if self.server is not None and self.server != server:
+                    server = self.server
+                    zc.add_listener(self, DNSQuestion(server, _TYPE_A, _CLASS_IN))
+                    continue
                 if next <= now:
-                    out = DNSOutgoing(_FLAGS_QR_QUERY)
-                    out.add_question(DNSQuestion(self.name, _TYPE_SRV,
-                                                 _CLASS_IN))
-                    out.add_answer_at_time(zc.cache.get_by_details(self.name,
-                                                                   _TYPE_SRV, _CLASS_IN), now)
-                    out.add_question(DNSQuestion(self.name, _TYPE_TXT,
-                                                 _CLASS_IN))
-                    out.add_answer_at_time(zc.cache.get_by_details(self.name,
-                                                                   _TYPE_TXT, _CLASS_IN), now)
-                    if self.server is not None:
-                        out.add_question(DNSQuestion(self.server,
-                                                     _TYPE_A, _CLASS_IN))
-                        out.add_answer_at_time(zc.cache.get_by_details(self.server,
-                                                                       _TYPE_A, _CLASS_IN), now)
-                    zc.send(out)
+                    zc.send(self.build_query(zc, now))
                     next = now + delay
                     delay = delay * 2
 
-                zc.wait(min(next, last) - now)
+                self.changed.wait((min(next, last) - now) / 1000)
+                self.changed.clear()
                 now = current_time_millis()
             result = True
         finally:
             zc.remove_listener(self)
+            self.changed = None
 
         return result
 
+    def build_query(self, zc, now):
+        """Returns a query for the service's SRV and TXT records and its
+        server's A record, with those already in the cache as known
+        answers"""
+        out = DNSOutgoing(_FLAGS_QR_QUERY)
+        out.add_question(DNSQuestion(self.name, _TYPE_SRV, _CLASS_IN))
+        out.add_answer_at_time(zc.cache.get_confirmed(self.name, _TYPE_SRV, _CLASS_IN), now)
+        out.add_question(DNSQuestion(self.name, _TYPE_TXT, _CLASS_IN))
+        out.add_answer_at_time(zc.cache.get_confirmed(self.name, _TYPE_TXT, _CLASS_IN), now)
+        if self.server is not None:
+            out.add_question(DNSQuestion(self.server, _TYPE_A, _CLASS_IN))
+            out.add_answer_at_time(zc.cache.get_confirmed(self.server, _TYPE_A, _CLASS_IN), now)
+        return out
+
     def __eq__(self, other):
         """Tests equality of service name"""
         if isinstance(other, ServiceInfo):
@@ -1249,11 +2444,51 @@ class Zeroconf(object):
     def __init__(
         self,
         interfaces=InterfaceChoice.Default,
+        filter_records=False,
+        max_packet_size=_MAX_MSG_TYPICAL,
+        cache_max_entries=None,
+        cache_max_bytes=None,
+        cache_file=None,
+        cache_save_interval=None,
+        collect_stats=False,
+        stats_callback=None,
+        stats_interval=60 * 1000,
+        receive_batch_size=_RECEIVE_BATCH_SIZE,
+        executor=None,
+        max_browser_events=_MAX_BROWSER_EVENTS,
     ):
         """Creates an instance of the Zeroconf class, establishing
         multicast communications, listening and reaping threads.
 
         :type interfaces: :class:`InterfaceChoice` or sequence of ip addresses
+        :param filter_records: if true, incoming records are only decoded
+            and cached when a listener, browser or registered service is
+            interested in their name
+        :param max_packet_size: outgoing messages are split into packets of
+            at most this many bytes
+        :param cache_max_entries: if given, the most records the cache holds
+        :param cache_max_bytes: if given, roughly the most bytes of memory
+            the cache's records take up
+        :param cache_file: if given, the cache is loaded from this file on
+            start, so that browsers find what was there at once, and saved
+            to it on close
+        :param cache_save_interval: if given along with cache_file, the
+            cache is also saved every this many milliseconds
+        :param collect_stats: if true, packets, queries, cache lookups and
+            the like are counted, for stats() to report
+        :param stats_callback: if given, statistics are collected and this
+            is called with stats() every stats_interval milliseconds
+        :param receive_batch_size: the most packets read from the
+            listening socket at a time, the responses among which update
+            the cache and wake waiting threads together
+        :param executor: if given, an object with a submit(fn) method,
+            such as a concurrent.futures executor, that passes the events
+            of browsers to their listeners; by default a pool of
+            _BROWSER_WORKERS threads is used where concurrent.futures is
+            available, and a thread started for them otherwise
+        :param max_browser_events: the most events pending for a
+            browser's listener, above which the oldest are dropped, or
+            None for no limit
         """
         global _GLOBAL_DONE
         _GLOBAL_DONE = False
@@ -1262,6 +2497,7 @@ class Zeroconf(object):
         interfaces = normalize_interface_choice(interfaces, socket.AF_INET)
 
         self._respond_sockets = []
+        self._respond_interfaces = {}
 
         for i in interfaces:
             self._listen_socket.setsockopt(
@@ -1273,24 +2509,65 @@ class Zeroconf(object):
                 socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(i))
 
             self._respond_sockets.append(respond_socket)
+            self._respond_interfaces[respond_socket] = i
+
+        self._listen_socket.setblocking(False)
+        self.receive_batch_size = receive_batch_size
+        self.executor = executor
+        self.own_executor = False
+        self.max_browser_events = max_browser_events
 
         self.listeners = []
+        self.listener_questions = {}
+        self.listener_index = {}
+        self.wildcard_listeners = []
+        self.wildcard_questions = 0
+        self.listeners_lock = threading.RLock()
         self.browsers = []
         self.services = {}
+        self.service_names = {}
         self.servicetypes = {}
+        self.responses = {}
+
+        self.filter_records = filter_records
+        self.max_packet_size = max_packet_size
+        self.statistics = None
+        if collect_stats or stats_callback is not None:
+            self.statistics = Statistics()
+        self.stats_callback = stats_callback
+        self.stats_interval = stats_interval
+
+        self.cache = DNSCache(cache_max_entries, cache_max_bytes)
+        self.cache.statistics = self.statistics
+        self.cache_file = cache_file
+        self.cache_save_interval = cache_save_interval
+        if cache_file is not None:
+            self.load_cache()
+        self.interest_counts = {}
+        self.interest_names = set()
+        self.interest = None
+        self.update_interest()
 
-        self.cache = DNSCache()
+        self.start()
 
+    def start(self):
+        """Starts the threads that read incoming packets, reap the cache
+        and run the browsers"""
         self.condition = threading.Condition()
 
         self.engine = Engine(self)
-        self.listener = Listener(self)
+        self.listener = Listener(self, self.receive_batch_size)
         self.engine.add_reader(self.listener, self._listen_socket)
         self.reaper = Reaper(self)
+        if self.executor is None and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(_BROWSER_WORKERS)
+            self.own_executor = True
+        self.scheduler = Scheduler(self)
 
     def wait(self, timeout):
         """Calling thread waits for a given number of milliseconds or
-        until notified."""
+        until notified, which happens when the instance is closed.
+        Threads waiting for records use events of their own."""
         with self.condition:
             self.condition.wait(timeout / 1000)
 
@@ -1333,6 +2610,8 @@ class Zeroconf(object):
             self.servicetypes[info.type] += 1
         else:
             self.servicetypes[info.type] = 1
+        self.responses = {}
+        self.add_service_interest(info)
         now = current_time_millis()
         next_time = now
         i = 0
@@ -1342,16 +2621,8 @@ class Zeroconf(object):
                 now = current_time_millis()
                 continue
             out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
-            out.add_answer_at_time(DNSPointer(info.type, _TYPE_PTR,
-                                              _CLASS_IN, ttl, info.name), 0)
-            out.add_answer_at_time(DNSService(info.name, _TYPE_SRV,
-                                              _CLASS_IN, ttl, info.priority, info.weight, info.port,
-                                              info.server), 0)
-            out.add_answer_at_time(DNSText(info.name, _TYPE_TXT, _CLASS_IN,
-                                           ttl, info.text), 0)
-            if info.address:
-                out.add_answer_at_time(DNSAddress(info.server, _TYPE_A,
-                                                  _CLASS_IN, ttl, info.address), 0)
+            for record in info.dns_records(ttl):
+                out.add_answer_at_time(record, 0)
             self.send(out)
             i += 1
             next_time += _REGISTER_TIME
@@ -1366,6 +2637,8 @@ class Zeroconf(object):
                 del self.servicetypes[info.type]
         except Exception as e:  # TODO stop catching all Exceptions
             log.exception('Unknown error, possibly benign: %r', e)
+        self.responses = {}
+        self.remove_service_interest(info)
         now = current_time_millis()
         next_time = now
         i = 0
@@ -1375,16 +2648,8 @@ class Zeroconf(object):
                 now = current_time_millis()
                 continue
             out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
-            out.add_answer_at_time(DNSPointer(info.type, _TYPE_PTR,
-                                              _CLASS_IN, 0, info.name), 0)
-            out.add_answer_at_time(DNSService(info.name, _TYPE_SRV,
-                                              _CLASS_IN, 0, info.priority, info.weight, info.port,
-                                              info.name), 0)
-            out.add_answer_at_time(DNSText(info.name, _TYPE_TXT, _CLASS_IN,
-                                           0, info.text), 0)
-            if info.address:
-                out.add_answer_at_time(DNSAddress(info.server, _TYPE_A,
-                                                  _CLASS_IN, 0, info.address), 0)
+            for record in info.dns_records(0):
+                out.add_answer_at_time(record, 0)
             self.send(out)
             i += 1
             next_time += _UNREGISTER_TIME
@@ -1402,16 +2667,8 @@ class Zeroconf(object):
                     continue
                 out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
                 for info in self.services.values():
-                    out.add_answer_at_time(DNSPointer(info.type, _TYPE_PTR,
-                                                      _CLASS_IN, 0, info.name), 0)
-                    out.add_answer_at_time(DNSService(info.name, _TYPE_SRV,
-                                                      _CLASS_IN, 0, info.priority, info.weight,
-                                                      info.port, info.server), 0)
-                    out.add_answer_at_time(DNSText(info.name, _TYPE_TXT,
-                                                   _CLASS_IN, 0, info.text), 0)
-                    if info.address:
-                        out.add_answer_at_time(DNSAddress(info.server,
-                                                          _TYPE_A, _CLASS_IN, 0, info.address), 0)
+                    for record in info.dns_records(0):
+                        out.add_answer_at_time(record, 0)
                 self.send(out)
                 i += 1
                 next_time += _UNREGISTER_TIME
@@ -1419,19 +2676,25 @@ class Zeroconf(object):
     def check_service(self, info):
         """Checks the network for a unique service name, modifying the
         ServiceInfo passed in if it is not unique."""
+        # Make sure answers to our probes get decoded and cached
+        self.add_listener(info, DNSQuestion(info.type, _TYPE_PTR, _CLASS_IN))
+        try:
+            self._check_service(info)
+        finally:
+            self.remove_listener(info)
+
+    def _check_service(self, info):
         now = current_time_millis()
         next_time = now
         i = 0
         while i < 3:
-            for record in self.cache.entries_with_name(info.type):
-                if (record.type == _TYPE_PTR and
-                        not record.is_expired(now) and
-                        record.alias == info.name):
+            for record in self.cache.entries_with_name_and_type(info.type, _TYPE_PTR):
+                if not record.is_expired(now) and record.alias == info.name:
                     if info.name.find('.') < 0:
                         info.name = '%s.[%s:%s].%s' % (info.name,
                                                        info.address, info.port, info.type)
 
-                        self.check_service(info)
+                        self._check_service(info)
                         return
                     raise NonUniqueNameException
             if now < next_time:
@@ -1441,8 +2704,7 @@ class Zeroconf(object):
             out = DNSOutgoing(_FLAGS_QR_QUERY | _FLAGS_AA)
             self.debug = out
             out.add_question(DNSQuestion(info.type, _TYPE_PTR, _CLASS_IN))
-            out.add_authorative_answer(DNSPointer(info.type, _TYPE_PTR,
-                                                  _CLASS_IN, _DNS_TTL, info.name))
+            out.add_authorative_answer(info.dns_records()[0])
             self.send(out)
             i += 1
             next_time += _CHECK_TIME
@@ -1450,52 +2712,285 @@ class Zeroconf(object):
     def add_listener(self, listener, question):
         """Adds a listener for a given question.  The listener will have
         its update_record method called when information is available to
-        answer the question."""
+        answer the question.
+
+        A listener may be added several times with different questions;
+        a question of None means it is interested in every record."""
         now = current_time_millis()
-        self.listeners.append(listener)
+        with self.listeners_lock:
+            questions = self.listener_questions.get(id(listener))
+            if questions is None:
+                questions = self.listener_questions[id(listener)] = []
+                self.listeners = self.listeners + [listener]
+            questions.append(question)
+            self.index_listener(listener, question)
         if question is not None:
-            for record in self.cache.entries_with_name(question.name):
+            if question.type == _TYPE_ANY:
+                records = self.cache.entries_with_name(question.name)
+            else:
+                records = self.cache.entries_with_name_and_type(question.name, question.type)
+            for record in records:
                 if question.answered_by(record) and not record.is_expired(now):
                     listener.update_record(self, now, record)
-        self.notify_all()
 
     def remove_listener(self, listener):
         """Removes a listener."""
-        try:
-            self.listeners.remove(listener)
-            self.notify_all()
-        except Exception as e:  # TODO stop catching all Exceptions
-            log.exception('Unknown error, possibly benign: %r', e)
+        with self.listeners_lock:
+            questions = self.listener_questions.pop(id(listener), None)
+            if questions is None:
+                return
+            self.listeners = [other for other in self.listeners if other is not listener]
+            for question in questions:
+                self.unindex_listener(listener, question)
+
+    def index_listener(self, listener, question):
+        """Adds a listener to the index of listeners by the lower-cased
+        name and the type of their questions, or to the list of those
+        with a question of None, and counts the question's name in the
+        interest.  Only the list the listener joins is replaced, so that
+        records can be dispatched while listeners come and go."""
+        if question is None:
+            if not any(other is listener for other in self.wildcard_listeners):
+                self.wildcard_listeners = self.wildcard_listeners + [listener]
+            self.wildcard_questions += 1
+            self.interest = None
+            return
+        name = question.name.lower()
+        key = (name, question.type)
+        bucket = self.listener_index.get(key, ())
+        if not any(other is listener for other in bucket):
+            self.listener_index[key] = list(bucket) + [listener]
+        self.add_interest([name])
+
+    def unindex_listener(self, listener, question):
+        """Undoes index_listener for one of a listener's questions"""
+        if question is None:
+            self.wildcard_listeners = [
+                other for other in self.wildcard_listeners if other is not listener]
+            self.wildcard_questions -= 1
+            if not self.wildcard_questions and self.filter_records:
+                self.interest = self.interest_names
+            return
+        name = question.name.lower()
+        key = (name, question.type)
+        bucket = [other for other in self.listener_index.get(key, ()) if other is not listener]
+        if bucket:
+            self.listener_index[key] = bucket
+        else:
+            self.listener_index.pop(key, None)
+        self.remove_interest([name])
+
+    def listeners_for(self, record):
+        """Returns the listeners with a question the record may answer,
+        each once"""
+        index = self.listener_index
+        listeners = index.get((record.key, record.type))
+        extra = index.get((record.key, _TYPE_ANY))
+        wildcard = self.wildcard_listeners
+        if extra is None and not wildcard:
+            return listeners or ()
+        listeners = list(listeners or ())
+        for bucket in (extra, wildcard):
+            for listener in bucket or ():
+                if not any(other is listener for other in listeners):
+                    listeners.append(listener)
+        return listeners
+
+    def add_interest(self, names):
+        """Counts one more question or service that names each of names.
+        A name counted for the first time joins the interest, the names
+        whose records incoming packets need to decode, and the names
+        whose records the cache must not evict."""
+        with self.listeners_lock:
+            for name in names:
+                count = self.interest_counts.get(name, 0)
+                self.interest_counts[name] = count + 1
+                if not count:
+                    self.interest_names.add(name)
+                    self.cache.protect(name)
+
+    def remove_interest(self, names):
+        """Undoes add_interest, dropping the names no longer counted"""
+        with self.listeners_lock:
+            for name in names:
+                count = self.interest_counts.get(name, 0)
+                if count > 1:
+                    self.interest_counts[name] = count - 1
+                elif count:
+                    del self.interest_counts[name]
+                    self.interest_names.discard(name)
+                    self.cache.unprotect(name)
+
+    def interesting_names(self, info):
+        """Returns the names of a registered service's records, and that
+        of service type enumeration, whose known answers it must see"""
+        names = [_SERVICE_TYPE_ENUMERATION_NAME, info.type.lower(), info.name.lower()]
+        if info.server is not None:
+            names.append(info.server.lower())
+        return names
+
+    def add_service_interest(self, info):
+        """Counts the names of a service being registered in the
+        interest, in place of those it was registered under before"""
+        key = info.name.lower()
+        names = self.interesting_names(info)
+        with self.listeners_lock:
+            self.remove_interest(self.service_names.pop(key, ()))
+            self.service_names[key] = names
+            self.add_interest(names)
+
+    def remove_service_interest(self, info):
+        """Undoes add_service_interest for a service being unregistered"""
+        with self.listeners_lock:
+            self.remove_interest(self.service_names.pop(info.name.lower(), ()))
+
+    def update_interest(self):
+        """Recounts the interest from the listeners' questions and the
+        services.  Adding and removing listeners and services keeps it
+        up to date; this is for a services dict changed directly."""
+        with self.listeners_lock:
+            counts = {}
+            self.wildcard_questions = 0
+            for questions in self.listener_questions.values():
+                for question in questions:
+                    if question is None:
+                        self.wildcard_questions += 1
+                    else:
+                        name = question.name.lower()
+                        counts[name] = counts.get(name, 0) + 1
+            self.service_names = {}
+            for key, info in list(self.services.items()):
+                names = self.service_names[key] = self.interesting_names(info)
+                for name in names:
+                    counts[name] = counts.get(name, 0) + 1
+            self.interest_counts = counts
+            # Replaced rather than changed, as it is all changed at once
+            self.interest_names = set(counts)
+            self.cache.protected = self.interest_names
+            if not self.filter_records or self.wildcard_questions:
+                self.interest = None
+            else:
+                self.interest = self.interest_names
 
     def update_record(self, now, rec):
-        """Used to notify listeners of new information that has updated
-        a record."""
-        for listener in self.listeners:
+        """Used to notify the listeners with a question the record may
+        answer of new information that has updated it."""
+        listeners = self.listeners_for(rec)
+        for listener in listeners:
             listener.update_record(self, now, rec)
-        self.notify_all()
+        if self.statistics is not None:
+            self.statistics.count('listener_callbacks', len(listeners))
+
+    def reap(self, now):
+        """Removes the records that have expired by now from the cache
+        and tells the listeners interested in each of them, logging
+        rather than raising what a listener raises"""
+        expired = self.cache.pop_expired(now)
+        for record in expired:
+            call_logging_errors(self.update_record, now, record)
+        if self.statistics is not None and expired:
+            self.statistics.count('records_reaped', len(expired))
+
+    def stats(self):
+        """Returns a dict of statistics: the state of the cache, and if
+        statistics are collected, counts of packets and bytes in and out
+        by socket, parse errors, queries answered, answers suppressed by
+        known answers, cache hits and misses, records reaped and
+        listener callbacks, browser events queued and coalesced, and the
+        time the engine takes to handle a packet and browser events wait
+        for and take to handle."""
+        cache = self.cache
+        result = {
+            'cache_entries': len(cache),
+            'cache_bytes': cache.bytes,
+            'cache_by_type': dict(
+                (_TYPES.get(type, str(type)), len(records))
+                for type, records in list(cache.types.items())),
+            'cache_evictions': cache.evictions,
+            'cache_evicted_bytes': cache.evicted_bytes,
+            'cache_unconfirmed': len(cache.unconfirmed),
+        }
+        if self.statistics is not None:
+            result.update(self.statistics.as_dict())
+        return result
 
     def handle_response(self, msg):
         """Deal with incoming response packets.  All answers
         are held in the cache, and listeners are notified."""
+        self.handle_responses([msg])
+
+    def handle_responses(self, msgs):
+        """Deal with a batch of incoming response packets.  Listeners
+        are notified of each answer, and the reaper is rescheduled once
+        for the whole batch."""
         now = current_time_millis()
-        for record in msg.answers:
-            expired = record.is_expired(now)
-            if record in self.cache.entries():
-                if expired:
-                    self.cache.remove(record)
-                else:
-                    entry = self.cache.get(record)
-                    if entry is not None:
+        callbacks = 0
+        for msg in msgs:
+            for record in msg.answers:
+                expired = record.is_expired(now)
+                entry = self.cache.get(record)
+                if entry is not None:
+                    if expired:
+                        self.cache.remove(entry)
+                    else:
                         entry.reset_ttl(record)
+                        self.cache.confirm(entry)
                         record = entry
-            else:
-                self.cache.add(record)
+                elif not expired:
+                    self.cache.add(record)
 
-            self.update_record(now, record)
+                listeners = self.listeners_for(record)
+                for listener in listeners:
+                    listener.update_record(self, now, record)
+                callbacks += len(listeners)
+
+        if callbacks and self.statistics is not None:
+            self.statistics.count('listener_callbacks', callbacks)
+        expiration = self.cache.next_expiration()
+        if expiration is not None:
+            self.reaper.notify(expiration)
 
     def handle_query(self, msg, addr, port):
         """Deal with incoming query packets.  Provides a response if
-        possible."""
+        possible.
+
+        Multicast responses to queries that carry no known answers are
+        kept by question set, so a repeated query is answered with the
+        packets already built.  They are dropped when services are
+        registered or unregistered, and a kept response is not used once
+        a registered ServiceInfo it was built from has been changed."""
+        key = None
+        if port == _MDNS_PORT and msg.num_answers == 0:
+            responses = self.responses
+            key = tuple((q.name, q.type, q.class_) for q in msg.questions)
+            cached = responses.get(key)
+            if cached is not None:
+                out, used = cached
+                if all(info.dns_records(_DNS_TTL, unique) is records
+                       for info, unique, records in used):
+                    if out is not None:
+                        self.send(out, addr, port)
+                    if self.statistics is not None:
+                        self.statistics.count(
+                            'queries_answered' if out is not None else 'queries_unanswered')
+                    return
+
+        used = []
+        out = self.build_response(msg, port, used)
+        if key is not None:
+            if len(responses) >= _MAX_CACHED_RESPONSES:
+                responses.clear()
+            responses[key] = (out, used)
+        if out is not None:
+            out.id = msg.id
+            self.send(out, addr, port)
+        if self.statistics is not None:
+            self.statistics.count('queries_answered' if out is not None else 'queries_unanswered')
+
+    def build_response(self, msg, port, used):
+        """Returns the response to a query, or None if there is nothing
+        to answer.  The registered services whose records were used are
+        added to used with the records."""
         out = None
 
         # Support unicast client responses
@@ -1507,20 +3002,20 @@ class Zeroconf(object):
 
         for question in msg.questions:
             if question.type == _TYPE_PTR:
-                if question.name == "_services._dns-sd._udp.local.":
+                if question.name == _SERVICE_TYPE_ENUMERATION_NAME:
                     for stype in self.servicetypes.keys():
                         if out is None:
                             out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
                         out.add_answer(msg,
-                                       DNSPointer("_services._dns-sd._udp.local.",
+                                       DNSPointer(_SERVICE_TYPE_ENUMERATION_NAME,
                                                   _TYPE_PTR, _CLASS_IN, _DNS_TTL, stype))
                 for service in self.services.values():
                     if question.name == service.type:
                         if out is None:
                             out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
-                        out.add_answer(msg,
-                                       DNSPointer(service.type, _TYPE_PTR,
-                                                  _CLASS_IN, _DNS_TTL, service.name))
+                        records = service.dns_records()
+                        used.append((service, False, records))
+                        out.add_answer(msg, records[0])
             else:
                 try:
                     if out is None:
@@ -1530,43 +3025,73 @@ class Zeroconf(object):
                     if question.type in (_TYPE_A, _TYPE_ANY):
                         for service in self.services.values():
                             if service.server == question.name.lower():
-                                out.add_answer(msg, DNSAddress(question.name,
-                                                               _TYPE_A, _CLASS_IN | _CLASS_UNIQUE,
-                                                               _DNS_TTL, service.address))
+                                records = service.dns_records(unique=True)
+                                used.append((service, True, records))
+                                if records[3] is not None:
+                                    out.add_answer(msg, records[3])
 
                     service = self.services.get(question.name.lower(), None)
                     if not service:
                         continue
 
+                    records = service.dns_records(unique=True)
+                    used.append((service, True, records))
+                    pointer, srv, text, address = records
                     if question.type in (_TYPE_SRV, _TYPE_ANY):
-                        out.add_answer(msg, DNSService(question.name,
-                                                       _TYPE_SRV, _CLASS_IN | _CLASS_UNIQUE,
-                                                       _DNS_TTL, service.priority, service.weight,
-                                                       service.port, service.server))
+                        out.add_answer(msg, srv)
                     if question.type in (_TYPE_TXT, _TYPE_ANY):
-                        out.add_answer(msg, DNSText(question.name,
-                                                    _TYPE_TXT, _CLASS_IN | _CLASS_UNIQUE,
-                                                    _DNS_TTL, service.text))
-                    if question.type == _TYPE_SRV:
-                        out.add_additional_answer(DNSAddress(service.server,
-                                                             _TYPE_A, _CLASS_IN | _CLASS_UNIQUE,
-                                                             _DNS_TTL, service.address))
+                        out.add_answer(msg, text)
+                    if question.type == _TYPE_SRV and address is not None:
+                        out.add_additional_answer(address)
                 except Exception as e:  # TODO stop catching all Exceptions
                     log.exception('Unknown error, possibly benign: %r', e)
 
+        if out is not None and self.statistics is not None and out.suppressed:
+            self.statistics.count('answers_suppressed', out.suppressed)
         if out is not None and out.answers:
-            out.id = msg.id
-            self.send(out, addr, port)
+            return out
+        return None
 
     def send(self, out, addr=_MDNS_ADDR, port=_MDNS_PORT):
-        """Sends an outgoing packet."""
-        packet = out.packet()
-        for s in self._respond_sockets:
-            bytes_sent = s.sendto(packet, 0, (addr, port))
-            if bytes_sent != len(packet):
-                raise Error(
-                    'Should not happen, sent %d out of %d bytes' % (
-                        bytes_sent, len(packet)))
+        """Sends an outgoing message, split into as many packets as
+        max_packet_size requires."""
+        statistics = self.statistics
+        for packet in out.packets(self.max_packet_size):
+            for s in self._respond_sockets:
+                bytes_sent = s.sendto(packet, 0, (addr, port))
+                if bytes_sent != len(packet):
+                    raise Error(
+                        'Should not happen, sent %d out of %d bytes' % (
+                            bytes_sent, len(packet)))
+                if statistics is not None:
+                    label = self._respond_interfaces[s]
+                    statistics.count(('packets_out', label))
+                    statistics.count(('bytes_out', label), bytes_sent)
+
+    def load_cache(self):
+        """Loads the cache from cache_file, if it can be read.  Returns
+        the number of records loaded."""
+        try:
+            with open(self.cache_file, 'rb') as f:
+                return len(self.cache.load(f, current_time_millis()))
+        except (IOError, OSError):
+            return 0
+        except (ValueError,) + _DECODE_ERRORS as e:
+            log.warning('Could not load cache from %s: %r', self.cache_file, e)
+            return 0
+
+    def save_cache(self):
+        """Saves the cache to cache_file, replacing it once the new
+        snapshot is written in full.  Returns true if it was saved."""
+        temporary = self.cache_file + '.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                self.cache.save(f, current_time_millis())
+            _replace_file(temporary, self.cache_file)
+            return True
+        except (IOError, OSError) as e:
+            log.warning('Could not save cache to %s: %r', self.cache_file, e)
+            return False
 
     def close(self):
         """Ends the background threads, and prevent this instance from
@@ -1576,6 +3101,15 @@ class Zeroconf(object):
             _GLOBAL_DONE = True
             self.notify_all()
             self.engine.notify()
+            self.reaper.notify()
+            self.scheduler.notify()
+            for listener in list(self.listeners):
+                if isinstance(listener, ServiceBrowser):
+                    listener.finished.set()
+            if self.own_executor:
+                self.executor.shutdown(wait=False)
+            if self.cache_file is not None:
+                self.save_cache()
             self.unregister_all_services()
             for s in [self._listen_socket] + self._respond_sockets:
                 s.close()
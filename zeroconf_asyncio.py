@@ -0,0 +1,414 @@
+""" Multicast DNS Service Discovery for Python on asyncio
+
+    This module runs the zeroconf module's implementation on an asyncio
+    event loop instead of its own threads: incoming packets are read by
+    an asyncio.DatagramProtocol, the cache is reaped by timers on the
+    loop, and registering, unregistering, resolving and browsing are
+    coroutines.  Packets, records and the cache are those of the
+    zeroconf module.
+
+    It needs Python 3.5 or later.
+
+    This library is free software; you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation; either
+    version 2.1 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library; if not, write to the Free Software
+    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301
+    USA
+"""
+
+import asyncio
+import enum
+import logging
+
+from zeroconf import (
+    _BROWSER_TIME,
+    _CHECK_TIME,
+    _CLASS_IN,
+    _DNS_TTL,
+    _FLAGS_AA,
+    _FLAGS_QR_QUERY,
+    _FLAGS_QR_RESPONSE,
+    _LISTENER_TIME,
+    _REGISTER_TIME,
+    _TYPE_A,
+    _TYPE_ANY,
+    _TYPE_PTR,
+    _UNREGISTER_TIME,
+    call_logging_errors,
+    current_time_millis,
+    DNSOutgoing,
+    DNSQuestion,
+    Error,
+    Listener,
+    NamePartTooLongException,
+    NonUniqueNameException,
+    ServiceInfo,
+    Zeroconf,
+)
+
+__all__ = [
+    "AsyncZeroconf", "AsyncServiceBrowser", "ServiceStateChange",
+]
+
+log = logging.getLogger(__name__)
+
+
+class ServiceStateChange(enum.Enum):
+    Added = 1
+    Removed = 2
+
+
+async def wait_for(event, timeout):
+    """Waits for an event for at most a given number of milliseconds,
+    and clears it"""
+    try:
+        await asyncio.wait_for(event.wait(), max(0, timeout) / 1000)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+
+    """Hands the packets received on the listening socket to the
+    Listener"""
+
+    def __init__(self, zc):
+        self.zc = zc
+
+    def datagram_received(self, data, addr):
+        # Malformed packets are skipped by the Listener, and the event
+        # loop reports what a listener raises
+        self.zc.listener.handle_data(data, addr[0], addr[1])
+
+
+class Reaper(object):
+
+    """Removes expired cache entries with a timer on the event loop,
+    set for when the next entry is due to expire, answers queries held
+    for their known answers once they are due, and saves the cache and
+    reports statistics as the Zeroconf instance asks for.  An error in
+    any of these is logged, and the timer is set again all the same."""
+
+    def __init__(self, zc, loop):
+        self.zc = zc
+        self.loop = loop
+        self.handle = None
+        self.deadline = None
+        self.cancelled = False
+        now = current_time_millis()
+        self.next_save = None
+        if zc.cache_file is not None and zc.cache_save_interval is not None:
+            self.next_save = now + zc.cache_save_interval
+        self.next_report = None
+        if zc.stats_callback is not None:
+            self.next_report = now + zc.stats_interval
+        self.schedule()
+
+    def notify(self, expiration=None):
+        """Sets the timer earlier if an entry expires before it is due"""
+        if not self.cancelled and (
+                expiration is None or self.deadline is None or expiration < self.deadline):
+            self.schedule()
+
+    def schedule(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        deadline = self.zc.cache.next_expiration()
+        for other in (self.next_save, self.next_report, self.zc.listener.next_truncated()):
+            if other is not None and (deadline is None or other < deadline):
+                deadline = other
+        self.deadline = deadline
+        if deadline is not None:
+            delay = max(0, deadline - current_time_millis()) / 1000
+            self.handle = self.loop.call_later(delay, self.run)
+
+    def run(self):
+        now = current_time_millis()
+        self.zc.reap(now)
+        call_logging_errors(self.zc.listener.flush_truncated, now)
+        if self.next_save is not None and self.next_save <= now:
+            call_logging_errors(self.zc.save_cache)
+            self.next_save = now + self.zc.cache_save_interval
+        if self.next_report is not None and self.next_report <= now:
+            call_logging_errors(self.zc.stats_callback, self.zc.stats())
+            self.next_report = now + self.zc.stats_interval
+        self.schedule()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+class AsyncZeroconf(Zeroconf):
+
+    """Zeroconf on an asyncio event loop, without threads of its own.
+
+    It takes the same arguments as Zeroconf, and must be created while
+    the loop it is to run on is running.  The listening socket is read
+    once open() has been awaited, which entering it as an async context
+    manager does as well.  Registering, unregistering, resolving and
+    closing are coroutines.
+
+    It has none of the threads of Zeroconf, so browsing is done with
+    browse() instead of ServiceBrowser or add_service_listener(), and
+    there is no wait() or notify_all().  Those raise
+    NotImplementedError.  Everything else is as in Zeroconf.
+    """
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.transport = None
+        self.listener = Listener(self)
+        self.reaper = Reaper(self, self.loop)
+
+    @property
+    def scheduler(self):
+        raise NotImplementedError("AsyncZeroconf runs no ServiceBrowsers; use browse()")
+
+    def add_service_listener(self, type, listener):
+        raise NotImplementedError("AsyncZeroconf runs no ServiceBrowsers; use browse()")
+
+    def remove_service_listener(self, listener):
+        raise NotImplementedError("AsyncZeroconf runs no ServiceBrowsers; use browse()")
+
+    def wait(self, timeout):
+        raise NotImplementedError("AsyncZeroconf has no threads to wait; await its coroutines")
+
+    def notify_all(self):
+        raise NotImplementedError("AsyncZeroconf has no threads to wait; await its coroutines")
+
+    async def open(self):
+        """Starts reading incoming packets"""
+        if self.transport is None:
+            self.transport, protocol = await self.loop.create_datagram_endpoint(
+                lambda: DatagramProtocol(self), sock=self._listen_socket)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def send_repeatedly(self, out_factory, interval):
+        """Sends three messages, interval milliseconds apart"""
+        for i in range(3):
+            if i:
+                await asyncio.sleep(interval / 1000)
+            self.send(out_factory())
+
+    async def get_service_info(self, type, name, timeout=3000):
+        """Returns network's service information for a particular
+        name and type, or None if no service matches by the timeout,
+        which defaults to 3 seconds."""
+        info = ServiceInfo(type, name)
+        if await self.request(info, timeout):
+            return info
+        return None
+
+    async def request(self, info, timeout):
+        """Returns true if the service could be discovered on the
+        network, and updates the ServiceInfo with details discovered."""
+        now = current_time_millis()
+        delay = _LISTENER_TIME
+        next = now + delay
+        last = now + timeout
+        server = None
+        info.changed = asyncio.Event()
+        self.add_listener(info, DNSQuestion(info.name, _TYPE_ANY, _CLASS_IN))
+        try:
+            while info.server is None or info.address is None or info.text is None:
+                if last <= now:
+                    return False
+                if info.server is not None and info.server != server:
+                    server = info.server
+                    self.add_listener(info, DNSQuestion(server, _TYPE_A, _CLASS_IN))
+                    continue
+                if next <= now:
+                    self.send(info.build_query(self, now))
+                    next = now + delay
+                    delay = delay * 2
+                await wait_for(info.changed, min(next, last) - now)
+                now = current_time_millis()
+            return True
+        finally:
+            self.remove_listener(info)
+            info.changed = None
+
+    async def register_service(self, info, ttl=_DNS_TTL):
+        """Registers service information to the network with a default TTL
+        of 60 seconds.  Zeroconf will then respond to requests for
+        information for that service.  The name of the service may be
+        changed if needed to make it unique on the network."""
+        await self.check_service(info)
+        self.services[info.name.lower()] = info
+        self.servicetypes[info.type] = self.servicetypes.get(info.type, 0) + 1
+        self.responses = {}
+        self.add_service_interest(info)
+        await self.send_repeatedly(lambda: self.announcement([info], ttl), _REGISTER_TIME)
+
+    async def unregister_service(self, info):
+        """Unregister a service."""
+        if self.services.pop(info.name.lower(), None) is not None:
+            if self.servicetypes[info.type] > 1:
+                self.servicetypes[info.type] -= 1
+            else:
+                del self.servicetypes[info.type]
+        self.responses = {}
+        self.remove_service_interest(info)
+        await self.send_repeatedly(lambda: self.announcement([info], 0), _UNREGISTER_TIME)
+
+    async def unregister_all_services(self):
+        """Unregister all registered services."""
+        if self.services:
+            services = list(self.services.values())
+            await self.send_repeatedly(lambda: self.announcement(services, 0), _UNREGISTER_TIME)
+
+    def announcement(self, infos, ttl):
+        """Returns a response holding the records of services"""
+        out = DNSOutgoing(_FLAGS_QR_RESPONSE | _FLAGS_AA)
+        for info in infos:
+            for record in info.dns_records(ttl):
+                out.add_answer_at_time(record, 0)
+        return out
+
+    async def check_service(self, info):
+        """Checks the network for a unique service name, modifying the
+        ServiceInfo passed in if it is not unique."""
+        self.add_listener(info, DNSQuestion(info.type, _TYPE_PTR, _CLASS_IN))
+        try:
+            while True:
+                for i in range(3):
+                    if i:
+                        await asyncio.sleep(_CHECK_TIME / 1000)
+                    if self.name_taken(info):
+                        break
+                    out = DNSOutgoing(_FLAGS_QR_QUERY | _FLAGS_AA)
+                    out.add_question(DNSQuestion(info.type, _TYPE_PTR, _CLASS_IN))
+                    out.add_authorative_answer(info.dns_records()[0])
+                    self.send(out)
+                else:
+                    return
+                if info.name.find('.') >= 0:
+                    raise NonUniqueNameException
+                info.name = '%s.[%s:%s].%s' % (info.name, info.address, info.port, info.type)
+        finally:
+            self.remove_listener(info)
+
+    def name_taken(self, info):
+        """Returns true if the cache holds another host's PTR record for
+        the service's name"""
+        now = current_time_millis()
+        return any(not record.is_expired(now) and record.alias == info.name
+                   for record in self.cache.entries_with_name_and_type(info.type, _TYPE_PTR))
+
+    def browse(self, type):
+        """Returns an AsyncServiceBrowser for a service type"""
+        return AsyncServiceBrowser(self, type)
+
+    async def close(self):
+        """Says goodbye for the registered services, saves the cache if
+        there is a cache_file, and stops reading incoming packets."""
+        await self.unregister_all_services()
+        if self.cache_file is not None:
+            self.save_cache()
+        self.reaper.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self._listen_socket.close()
+        for s in self._respond_sockets:
+            s.close()
+
+
+class AsyncServiceBrowser(object):
+
+    """Browses for the instances of a service type on an asyncio event
+    loop, sending queries from a task.
+
+    It is an async iterator of (ServiceStateChange, name) pairs, which
+    ends once the browser is cancelled."""
+
+    def __init__(self, zc, type):
+        self.zc = zc
+        self.type = type
+        self.services = {}
+        self.events = asyncio.Queue()
+        self.next_time = current_time_millis()
+        self.delay = _BROWSER_TIME
+        self.done = False
+        self.changed = asyncio.Event()
+        self.zc.add_listener(self, DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
+        self.task = asyncio.ensure_future(self.run())
+
+    def update_record(self, zc, now, record):
+        """Callback invoked by Zeroconf when new information arrives."""
+        if record.type != _TYPE_PTR or record.name != self.type:
+            return
+        key = record.alias.lower()
+        known = self.services.get(key)
+        if record.is_expired(now):
+            if known is not None:
+                del self.services[key]
+                self.events.put_nowait((ServiceStateChange.Removed, record.alias))
+            return
+        if known is not None:
+            known.reset_ttl(record)
+        else:
+            self.services[key] = record
+            self.events.put_nowait((ServiceStateChange.Added, record.alias))
+        expires = record.get_expiration_time(75)
+        if expires < self.next_time:
+            self.next_time = expires
+            self.changed.set()
+
+    async def run(self):
+        while not self.done:
+            now = current_time_millis()
+            if self.next_time > now:
+                await wait_for(self.changed, self.next_time - now)
+                continue
+            out = DNSOutgoing(_FLAGS_QR_QUERY)
+            out.add_question(DNSQuestion(self.type, _TYPE_PTR, _CLASS_IN))
+            for record in self.services.values():
+                if (not record.is_expired(now) and
+                        record not in self.zc.cache.unconfirmed):
+                    out.add_answer_at_time(record, now)
+            try:
+                self.zc.send(out)
+            except (OSError, Error, NamePartTooLongException) as e:
+                log.warning('Could not send the query of %s: %r', self.type, e)
+            self.next_time = now + self.delay
+            self.delay = min(20 * 1000, self.delay * 2)
+
+    def cancel(self):
+        """Stops browsing, ending the iteration once the events already
+        received have been consumed"""
+        if not self.done:
+            self.done = True
+            self.zc.remove_listener(self)
+            self.task.cancel()
+            self.events.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.events.get()
+        if event is None:
+            self.events.put_nowait(None)
+            raise StopAsyncIteration
+        return event